@@ -1,26 +1,17 @@
 from torch.utils.data import Dataset
-import lmdb
 from io import BytesIO
 from PIL import Image
 import torchvision.transforms as tfs
 import os
 
+from .lmdb_reader import LMDBReader
+
 class MultiResolutionDataset(Dataset):
-    def __init__(self, path, transform, resolution=256):
-        self.env = lmdb.open(
-            path,
-            max_readers=32,
-            readonly=True,
-            lock=False,
-            readahead=False,
-            meminit=False,
-        )
-
-        if not self.env:
-            raise IOError("Cannot open lmdb dataset", path)
-
-        with self.env.begin(write=False) as txn:
-            self.length = int(txn.get("length".encode("utf-8")).decode("utf-8"))
+    def __init__(self, path, transform, resolution=256, max_readers=32):
+        # opened lazily in every worker, see LMDBReader
+        self.reader = LMDBReader(path, max_readers=max_readers)
+        self.length = int(self.reader.get("length".encode("utf-8")).decode("utf-8"))
+        self.reader.close()
 
         self.resolution = resolution
         self.transform = transform
@@ -28,17 +19,23 @@ class MultiResolutionDataset(Dataset):
     def __len__(self):
         return self.length
 
-    def __getitem__(self, index):
-        with self.env.begin(write=False) as txn:
-            key = f"{self.resolution}-{str(index).zfill(5)}".encode("utf-8")
-            img_bytes = txn.get(key)
+    def _key(self, index):
+        return f"{self.resolution}-{str(index).zfill(5)}".encode("utf-8")
 
+    def _decode(self, img_bytes):
         buffer = BytesIO(img_bytes)
         img = Image.open(buffer)
         img = self.transform(img)
 
         return img
 
+    def __getitem__(self, index):
+        return self._decode(self.reader.get(self._key(index)))
+
+    def __getitems__(self, indices):
+        # a whole batch of the DataLoader in one cursor pass
+        return [self._decode(img_bytes) for img_bytes in self.reader.get_many([self._key(i) for i in indices])]
+
 
 ################################################################################
 
@@ -51,10 +48,12 @@ def get_celeba_dataset(data_root, config):
                                   tfs.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5),
                                                 inplace=True)])
 
+    # one reader slot for every loader worker and the main process
+    max_readers = max(32, config.data.num_workers + 1)
     train_dataset = MultiResolutionDataset(os.path.join(data_root, 'LMDB_train'),
-                                           train_transform, config.data.image_size)
+                                           train_transform, config.data.image_size, max_readers)
     test_dataset = MultiResolutionDataset(os.path.join(data_root, 'LMDB_test'),
-                                          test_transform, config.data.image_size)
+                                          test_transform, config.data.image_size, max_readers)
 
 
     return train_dataset, test_dataset
@@ -1,6 +1,6 @@
 from PIL import Image
-from glob import glob
 import os
+import pickle
 from torch.utils.data import Dataset
 import math
 import numpy as np
@@ -19,15 +19,49 @@ def get_imagenet_dataset(data_root, config, class_num=None, random_crop=False, r
 ###################################################################
 
 
+def build_manifest(image_root, mode):
+    """Sorted relative paths, class directories and file sizes of the images of a split,
+    with the [start, end) range of every class in the lists."""
+    split_dir = os.path.join(image_root, mode)
+    paths, classes, sizes, class_ranges = [], [], [], {}
+    for class_dir in sorted(entry.name for entry in os.scandir(split_dir) if entry.is_dir()):
+        start = len(paths)
+        entries = sorted((entry for entry in os.scandir(os.path.join(split_dir, class_dir))
+                          if entry.name.endswith('.JPEG')), key=lambda entry: entry.name)
+        for entry in entries:
+            paths.append(os.path.join(class_dir, entry.name))
+            classes.append(class_dir)
+            sizes.append(entry.stat().st_size)
+        class_ranges[class_dir] = (start, len(paths))
+    return {'paths': paths, 'classes': classes, 'sizes': sizes, 'class_ranges': class_ranges}
+
+
+def load_manifest(image_root, mode):
+    """Manifest of a split, built by walking the split once and cached next to it."""
+    cache_file = os.path.join(image_root, f"_manifest_{mode}.pkl")
+    if os.path.isfile(cache_file):
+        with open(cache_file, "rb") as f:
+            return pickle.load(f)
+
+    manifest = build_manifest(image_root, mode)
+    try:
+        with open(cache_file, "wb") as f:
+            pickle.dump(manifest, f)
+    except OSError:
+        print(f'Cannot cache the manifest of {mode} in {image_root}')
+    return manifest
+
+
 class IMAGENET_dataset(Dataset):
     def __init__(self, image_root, mode='val', class_num=None, img_size=512, random_crop=True, random_flip=False):
         super().__init__()
+        manifest = load_manifest(image_root, mode)
         if class_num is not None:
-            self.data_dir = os.path.join(image_root, mode, IMAGENET_DIC[str(class_num)][0], '*.JPEG')
-            self.image_paths = sorted(glob(self.data_dir))
+            start, end = manifest['class_ranges'].get(IMAGENET_DIC[str(class_num)][0], (0, 0))
         else:
-            self.data_dir = os.path.join(image_root, mode, '*', '*.JPEG')
-            self.image_paths = sorted(glob(self.data_dir))
+            start, end = 0, len(manifest['paths'])
+        self.data_dir = os.path.join(image_root, mode)
+        self.image_paths = [os.path.join(self.data_dir, path) for path in manifest['paths'][start:end]]
         self.img_size = img_size
         self.random_crop = random_crop
         self.random_flip = random_flip
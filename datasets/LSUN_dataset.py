@@ -1,4 +1,5 @@
 import os.path
+import bisect
 from collections.abc import Iterable
 from torchvision.datasets.utils import verify_str_arg, iterable_to_str
 
@@ -94,37 +95,27 @@ class StandardTransform(object):
 ################################################################
 
 class LSUNClass(VisionDataset):
-    def __init__(self, root, transform=None, target_transform=None):
-        import lmdb
+    def __init__(self, root, transform=None, target_transform=None, max_readers=32):
+        from .lmdb_reader import LMDBReader
 
         super(LSUNClass, self).__init__(
             root, transform=transform, target_transform=target_transform
         )
 
-        self.env = lmdb.open(
-            root,
-            max_readers=1,
-            readonly=True,
-            lock=False,
-            readahead=False,
-            meminit=False,
-        )
-        with self.env.begin(write=False) as txn:
-            self.length = txn.stat()["entries"]
+        # opened lazily in every worker, see LMDBReader
+        self.reader = LMDBReader(root, max_readers=max_readers)
+        self.length = self.reader.stat()["entries"]
         root_split = root.split("/")
         cache_file = os.path.join("/".join(root_split[:-1]), f"_cache_{root_split[-1]}")
         if os.path.isfile(cache_file):
             self.keys = pickle.load(open(cache_file, "rb"))
         else:
-            with self.env.begin(write=False) as txn:
-                self.keys = [key for key, _ in txn.cursor()]
+            self.keys = self.reader.keys()
             pickle.dump(self.keys, open(cache_file, "wb"))
+        self.reader.close()
 
-    def __getitem__(self, index):
+    def _decode(self, imgbuf):
         img, target = None, None
-        env = self.env
-        with env.begin(write=False) as txn:
-            imgbuf = txn.get(self.keys[index])
 
         buf = io.BytesIO()
         buf.write(imgbuf)
@@ -139,6 +130,13 @@ class LSUNClass(VisionDataset):
 
         return img, target
 
+    def __getitem__(self, index):
+        return self._decode(self.reader.get(self.keys[index]))
+
+    def __getitems__(self, indices):
+        # a whole batch of the DataLoader in one cursor pass
+        return [self._decode(imgbuf) for imgbuf in self.reader.get_many([self.keys[i] for i in indices])]
+
     def __len__(self):
         return self.length
 
@@ -158,7 +156,7 @@ class LSUN(VisionDataset):
             target and transforms it.
     """
 
-    def __init__(self, root, classes="train", transform=None, target_transform=None):
+    def __init__(self, root, classes="train", transform=None, target_transform=None, max_readers=32):
         super(LSUN, self).__init__(
             root, transform=transform, target_transform=target_transform
         )
@@ -168,7 +166,7 @@ class LSUN(VisionDataset):
         self.dbs = []
         for c in self.classes:
             self.dbs.append(
-                LSUNClass(root=root + "/" + c + "_lmdb", transform=transform)
+                LSUNClass(root=root + "/" + c + "_lmdb", transform=transform, max_readers=max_readers)
             )
 
         self.indices = []
@@ -254,6 +252,21 @@ class LSUN(VisionDataset):
         img, _ = db[index]
         return img#, target
 
+    def __getitems__(self, indices):
+        # indices grouped by database, every database is read in one pass
+        groups = {}
+        for i, index in enumerate(indices):
+            target = bisect.bisect_right(self.indices, index)
+            sub = self.indices[target - 1] if target > 0 else 0
+            groups.setdefault(target, []).append((i, index - sub))
+
+        imgs = [None] * len(indices)
+        for target, items in groups.items():
+            samples = self.dbs[target].__getitems__([index for _, index in items])
+            for (i, _), (img, _) in zip(items, samples):
+                imgs[i] = img
+        return imgs
+
     def __len__(self):
         return self.length
 
@@ -271,9 +284,13 @@ def get_lsun_dataset(data_root, config):
     train_folder = "{}_train".format(config.data.category)
     val_folder = "{}_val".format(config.data.category)
 
+    # one reader slot for every loader worker and the main process
+    max_readers = max(32, config.data.num_workers + 1)
+
     train_dataset = LSUN(
         root=os.path.join(data_root),
         classes=[train_folder],
+        max_readers=max_readers,
         transform=tfs.Compose(
             [
                 tfs.Resize(config.data.image_size),
@@ -288,6 +305,7 @@ def get_lsun_dataset(data_root, config):
     test_dataset = LSUN(
         root=os.path.join(data_root),
         classes=[val_folder],
+        max_readers=max_readers,
         transform=tfs.Compose(
             [
                 tfs.Resize(config.data.image_size),
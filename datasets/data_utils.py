@@ -3,8 +3,17 @@ from .CelebA_HQ_dataset import get_celeba_dataset
 from .LSUN_dataset import get_lsun_dataset
 from torch.utils.data import DataLoader
 from .IMAGENET_dataset import get_imagenet_dataset
+from .shard_dataset import get_shard_dataset, shard_root, has_shards
+import os
+
+def get_dataset(dataset_type, dataset_paths, config, target_class_num=None, gender=None, use_shards=True):
+    # Pre-tensorized shards written by datasets/shard_dataset.py are read when they exist
+    if use_shards and target_class_num is None and dataset_type in dataset_paths:
+        # the test split is converted last
+        root = shard_root(dataset_paths[dataset_type], config.data.category, config.data.image_size)
+        if has_shards(os.path.join(root, 'test'), config.data.category):
+            return get_shard_dataset(dataset_paths[dataset_type], config)
 
-def get_dataset(dataset_type, dataset_paths, config, target_class_num=None, gender=None):
     if dataset_type == 'AFHQ':
         train_dataset, test_dataset = get_afhq_dataset(dataset_paths['AFHQ'], config)
     elif dataset_type == "LSUN":
@@ -0,0 +1,61 @@
+import os
+
+from PIL import Image
+from torch.utils.data import Dataset
+import torchvision.transforms as tfs
+
+IMG_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.webp')
+
+
+class Folder_dataset(Dataset):
+    """Images of a folder decoded, and optionally aligned, in the loader workers.
+    Every worker loads its own face landmark predictor on first use."""
+
+    def __init__(self, image_paths, transform=None, img_size=256, align_face=False):
+        super().__init__()
+        self.image_paths = image_paths
+        self.transform = transform
+        self.img_size = img_size
+        self.align_face = align_face
+        self.predictor = None
+
+    def __getitem__(self, index):
+        image_path = self.image_paths[index]
+        x = self._align(image_path) if self.align_face else None
+        if x is None:
+            x = Image.open(image_path).convert('RGB')
+        x = x.resize((self.img_size, self.img_size))
+        if self.transform is not None:
+            x = self.transform(x)
+        return x, os.path.basename(image_path)
+
+    def _align(self, image_path):
+        from utils.align_utils import get_predictor, align_face
+
+        if self.predictor is None:
+            self.predictor = get_predictor()
+        try:
+            return align_face(filepath=image_path, predictor=self.predictor,
+                              output_size=self.img_size, transform_size=self.img_size)
+        except Exception:
+            # no face found, the image is used as it is
+            return None
+
+    def __len__(self):
+        return len(self.image_paths)
+
+
+################################################################################
+
+def list_images(folder):
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                  if name.lower().endswith(IMG_EXTENSIONS))
+
+
+def get_folder_dataset(image_paths, config, align_face=False):
+    test_transform = tfs.Compose([tfs.ToTensor(),
+                                  tfs.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5),
+                                                inplace=True)])
+
+    return Folder_dataset(image_paths, transform=test_transform, img_size=config.data.image_size,
+                          align_face=align_face)
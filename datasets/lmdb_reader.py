@@ -0,0 +1,72 @@
+import os
+
+import lmdb
+
+
+class LMDBReader(object):
+    """Read-only LMDB access shared by the DataLoader workers.
+
+    The environment is opened lazily in the process that reads, never
+    inherited through fork, and every process keeps a single read
+    transaction for its lifetime (the databases are never written while
+    they are read). `get_many` fetches many keys with one cursor pass
+    in key order.
+    """
+
+    def __init__(self, path, max_readers=32):
+        self.path = path
+        self.max_readers = max_readers
+        self.env = None
+        self.txn = None
+        self.pid = None
+
+    def _open(self):
+        if self.env is not None and self.pid == os.getpid():
+            return
+        self.env = lmdb.open(
+            self.path,
+            max_readers=self.max_readers,
+            readonly=True,
+            lock=False,
+            readahead=False,
+            meminit=False,
+        )
+        if not self.env:
+            raise IOError("Cannot open lmdb dataset", self.path)
+        self.txn = self.env.begin(write=False)
+        self.pid = os.getpid()
+
+    def close(self):
+        if self.pid == os.getpid():
+            if self.txn is not None:
+                self.txn.abort()
+            if self.env is not None:
+                self.env.close()
+        self.env, self.txn, self.pid = None, None, None
+
+    def stat(self):
+        self._open()
+        return self.txn.stat()
+
+    def keys(self):
+        self._open()
+        return [key for key, _ in self.txn.cursor()]
+
+    def get(self, key):
+        self._open()
+        return self.txn.get(key)
+
+    def get_many(self, keys):
+        self._open()
+        values = [None] * len(keys)
+        cursor = self.txn.cursor()
+        for i in sorted(range(len(keys)), key=keys.__getitem__):
+            if cursor.set_key(keys[i]):
+                values[i] = cursor.value()
+        return values
+
+    def __getstate__(self):
+        # workers started with spawn open their own environment
+        state = self.__dict__.copy()
+        state.update(env=None, txn=None, pid=None)
+        return state
@@ -0,0 +1,132 @@
+"""
+Pre-tensorized dataset shards.
+
+The images of a dataset split are stored once as uint8 CHW arrays at the
+image size of the config, in shards of tensor files (utils/tensor_file.py)
+with an index.json listing them and the category they were converted from. Reading a shard maps it, items are views
+of the mapped file and no image is decoded or resized. The images are
+normalized to [-1, 1] after the transfer to the device, see `normalize`.
+
+Conversion of the datasets of a config:
+    python -m datasets.shard_dataset --config celeba.yml
+"""
+
+import os
+import json
+import bisect
+import argparse
+
+import yaml
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from utils.tensor_file import TENSOR_FILE_EXT, save_tensor_file, load_tensor_file
+
+INDEX_FILE = 'index.json'
+
+
+def shard_root(data_root, category, image_size):
+    # the categories of a dataset (LSUN bedroom and church_outdoor) share its data root
+    return os.path.join(data_root, f'shards_{category}_{image_size}')
+
+
+def has_shards(root, category):
+    path = os.path.join(root, INDEX_FILE)
+    if not os.path.exists(path):
+        return False
+    with open(path, 'r') as f:
+        index_category = json.load(f).get('category')
+    if index_category != category:
+        print(f'Shards in {root} are of category {index_category}, not {category}, they are not used')
+        return False
+    return True
+
+
+def normalize(x):
+    """uint8 images to [-1, 1], other images are returned as they are."""
+    if x.dtype != torch.uint8:
+        return x
+    return x.float() / 127.5 - 1
+
+
+class Shard_dataset(Dataset):
+    def __init__(self, root):
+        super().__init__()
+        self.root = root
+        with open(os.path.join(root, INDEX_FILE), 'r') as f:
+            index = json.load(f)
+        self.shard_names = [shard['name'] for shard in index['shards']]
+        self.offsets = []
+        count = 0
+        for shard in index['shards']:
+            count += shard['count']
+            self.offsets.append(count)
+        self.length = count
+        self.shards = {}
+
+    def _shard(self, i):
+        # mapped on first use in every worker
+        if i not in self.shards:
+            self.shards[i] = load_tensor_file(os.path.join(self.root, self.shard_names[i]))['images']
+        return self.shards[i]
+
+    def __getitem__(self, index):
+        i = bisect.bisect_right(self.offsets, index)
+        start = self.offsets[i - 1] if i > 0 else 0
+        return self._shard(i)[index - start]
+
+    def __len__(self):
+        return self.length
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+
+################################################################################
+
+def get_shard_dataset(data_root, config):
+    root = shard_root(data_root, config.data.category, config.data.image_size)
+    return Shard_dataset(os.path.join(root, 'train')), Shard_dataset(os.path.join(root, 'test'))
+
+
+def write_shards(dataset, root, category, shard_size=1024, num_workers=8):
+    """Stores the normalized images of `dataset`, of `category`, as uint8 shards in `root`."""
+    os.makedirs(root, exist_ok=True)
+    loader = DataLoader(dataset, batch_size=shard_size, shuffle=False, num_workers=num_workers)
+
+    shards = []
+    for i, x in enumerate(loader):
+        x = torch.as_tensor(x)
+        images = ((x + 1) * 127.5).round().clamp(0, 255).to(torch.uint8).contiguous()
+        name = f'{i:05d}{TENSOR_FILE_EXT}'
+        save_tensor_file({'images': images}, os.path.join(root, name))
+        shards.append({'name': name, 'count': len(images)})
+        print(f'{root}/{name}: {len(images)} images')
+
+    # the index is written last, a partial conversion is never picked up
+    with open(os.path.join(root, INDEX_FILE), 'w') as f:
+        json.dump({'category': category, 'shards': shards}, f)
+
+
+if __name__ == '__main__':
+    from main import dict2namespace
+    from configs.paths_config import DATASET_PATHS
+    from datasets.data_utils import get_dataset
+
+    parser = argparse.ArgumentParser(description='Convert the datasets of a config into uint8 shards')
+    parser.add_argument('--config', type=str, required=True, help='Path to the config file')
+    parser.add_argument('--shard_size', type=int, default=1024, help='# of images per shard')
+    parser.add_argument('--num_workers', type=int, default=8, help='# of decoding workers')
+    args = parser.parse_args()
+
+    with open(os.path.join('configs', args.config), 'r') as f:
+        config = dict2namespace(yaml.safe_load(f))
+
+    dataset_type = config.data.dataset
+    category = config.data.category
+    root = shard_root(DATASET_PATHS[dataset_type], category, config.data.image_size)
+    train_dataset, test_dataset = get_dataset(dataset_type, DATASET_PATHS, config, use_shards=False)
+    write_shards(train_dataset, os.path.join(root, 'train'), category, args.shard_size, args.num_workers)
+    write_shards(test_dataset, os.path.join(root, 'test'), category, args.shard_size, args.num_workers)
@@ -1,27 +1,30 @@
 import time
 import os
+import hashlib
 import numpy as np
-import torchvision.utils as tvu
 import torchvision.transforms as tfs
 import torch
 
 from torch import nn
-from pynvml import *
 from PIL import Image
 
+# Heavy dependencies are imported on the code paths that use them:
+# CLIP in _conf_loss (fine-tuning only), the datasets and lmdb in
+# precompute_latents, dlib and scipy in _open_image with --align_face
 from models.ddpm.diffusion import DDPM
 from models.improved_ddpm.script_util import i_DDPM
 from utils.text_dic import SRC_TRG_TXT_DIC
-from utils.diffusion_utils import get_beta_schedule, denoising_step
-from losses import id_loss
-from losses.clip_loss import CLIPLoss
-from datasets.data_utils import get_dataset, get_dataloader
-from utils.align_utils import run_alignment
+from utils.diffusion_utils import get_beta_schedule, denoising_step, get_timestep_seq, DeepCache
+from utils.latent_cache import LatentCache, tensor_digest, file_digest
+from utils.tensor_file import is_tensor_file, converted_path, load_model, load_state
+from utils.shared_weights import is_delta_file
+from utils.image_writer import AsyncImageWriter
+from utils.pair_store import PairStore
 from configs.paths_config import DATASET_PATHS, MODEL_PATHS
 
 
 class EffDiff(object):
-    def __init__(self, args, config, device=None):
+    def __init__(self, args, config, device=None, latent_cache=None, checkpoints=None):
 
         # ---------------------
         # Basic configurations
@@ -60,13 +63,30 @@ class EffDiff(object):
         self.logvar = torch.tensor(self.logvar).float().to(self.device)
         # ---------------------
 
+        # ---------------------
+        # Cache of inverted latents, may be shared
+        # between runners of a serving process
+        if latent_cache is None and self.args.latent_cache_size > 0:
+            latent_cache = LatentCache(self.args.latent_cache_size, self.args.latent_cache_dir)
+        self.latent_cache = latent_cache
+
+        # Store of fine-tuned models kept
+        # on the device between requests
+        self.checkpoints = checkpoints
+
+        # Images are encoded and written
+        # in the background
+        self.writer = AsyncImageWriter(fmt=self.args.save_format,
+                                       quality=self.args.save_quality,
+                                       per_image=self.args.save_per_image)
+        # ---------------------
+
         # ---------------------
         # Configuration of models,
         # optimizer, losses
         # and timestamps
         self._conf_model()
         self._conf_opt()
-        self._conf_loss()
         self._conf_seqs()
         # ---------------------
 
@@ -95,34 +115,90 @@ class EffDiff(object):
                         sample_type='ddim',
                         is_one_step=False,
                         simple=False,
-                        is_grad=False):
+                        is_grad=False,
+                        models=None,
+                        ratio=1.0):
         if simple:
             t0 = self.args.t_0
             l1 = self.alphas_cumprod[t0]
             x = x * l1 ** 0.5 + (1 - l1) ** 0.5 * torch.randn_like(x)
             return x
 
+        # Deep features are only reused in sampling, never under gradients,
+        # every model of a mixture keeps its own features
+        cache = None
+        if self.args.cache_interval > 1 and not is_grad:
+            if type(models) == list:
+                cache = [DeepCache(self.args.cache_interval, self.args.cache_branch) for _ in models]
+            else:
+                cache = DeepCache(self.args.cache_interval, self.args.cache_branch)
+
+        # x0 predictions of the previous steps for the multistep solvers
+        x0_prevs = []
+
         n = len(x)
         with torch.set_grad_enabled(is_grad):
             for it, (i, j) in enumerate(zip(seq_prev, seq_next)):
                 t = (torch.ones(n) * i).to(self.device)
                 t_prev = (torch.ones(n) * j).to(self.device)
 
+                if cache is not None:
+                    for c in (cache if type(cache) == list else [cache]):
+                        c.step()
+
                 x, x0 = denoising_step(x,
                                        t=t,
                                        t_next=t_prev,
-                                       models=self.model,
+                                       models=self.model if models is None else models,
                                        logvars=self.logvar,
                                        sampling_type=sample_type,
                                        b=self.betas,
                                        eta=eta,
                                        out_x0_t=True,
-                                       learn_sigma=self.learn_sigma)
+                                       learn_sigma=self.learn_sigma,
+                                       ratio=ratio,
+                                       cache=cache,
+                                       x0_prevs=x0_prevs)
 
                 if is_one_step:
                     return x0
 
+                x0_prevs = x0_prevs[-1:] + [(t, x0)]
+
+        return x
+
+    # Inversion of a real image, the latent is reused if the
+    # same image was already inverted with the same settings
+    def invert(self, x0, is_stoch=False):
+        key = None
+        if self.latent_cache is not None and not is_stoch:
+            key = self.latent_key(x0)
+            x_lat = self.latent_cache.get(key)
+            if x_lat is not None:
+                return x_lat.to(self.device)
+
+        x = self.apply_diffusion(x=x0.clone(),
+                                 seq_prev=self.seq_inv_next[1:],
+                                 seq_next=self.seq_inv[1:],
+                                 sample_type=self.args.inv_sample_type,
+                                 is_grad=False,
+                                 simple=is_stoch)
+
+        if key is not None:
+            self.latent_cache.put(key, x)
         return x
+
+    def latent_key(self, x0, t_0=None, n_inv_step=None, skip_type=None, inv_sample_type=None, cache_interval=None):
+        t_0 = self.args.t_0 if t_0 is None else t_0
+        n_inv_step = self.args.n_inv_step if n_inv_step is None else n_inv_step
+        skip_type = self.args.skip_type if skip_type is None else skip_type
+        inv_sample_type = self.args.inv_sample_type if inv_sample_type is None else inv_sample_type
+        cache_interval = self.args.cache_interval if cache_interval is None else cache_interval
+        # the branch only matters when deep features are reused
+        cache_branch = self.args.cache_branch if cache_interval > 1 else 0
+        return self.latent_cache.key(tensor_digest(x0), self.model_digest, t_0, n_inv_step,
+                                     self.args.align_face, inv_sample_type, skip_type,
+                                     cache_interval, cache_branch)
     # ----------------------------------------------------------------------------------
 
     # Computing latent variables
@@ -141,7 +217,7 @@ class EffDiff(object):
 
             img_lat_pairs = []
             pairs_path = os.path.join('precomputed/',
-                                      f'{self.config.data.category}_{self.mode}_t{self.args.t_0}_nim{self.args.n_precomp_img}_ninv{self.args.n_inv_step}_pairs.pth')
+                                      f'{self.config.data.category}_{self.mode}_t{self.args.t_0}_nim{self.args.n_precomp_img}_ninv{self.args.n_inv_step}{self._inv_suffix()}_pairs.pth')
 
             # Loading latent variables if so exists
             # --------------------------------------------------
@@ -155,6 +231,9 @@ class EffDiff(object):
                     loader = os.listdir('imgs_for_train')
                     n_precomp_img = len(loader)
                 else:
+                    from datasets.data_utils import get_dataset, get_dataloader
+                    from datasets.shard_dataset import normalize
+
                     train_dataset, test_dataset = get_dataset(self.config.data.dataset, DATASET_PATHS, self.config)
                     loader_dic = get_dataloader(train_dataset, test_dataset, bs_train=self.args.bs_train,
                                                 num_workers=self.config.data.num_workers)
@@ -190,7 +269,7 @@ class EffDiff(object):
                         img = train_transform(self._open_image(f"imgs_for_test/{self.args.own_test}"))
                         x0 = img.to(self.config.device).unsqueeze(0)
                     else:
-                        x0 = img.to(self.config.device)
+                        x0 = normalize(img.to(self.config.device))
                 else:
                     if self.mode == 'train' and self.args.own_training:
                         img = train_transform(self._open_image(f"imgs_for_train/{img}"))
@@ -199,20 +278,14 @@ class EffDiff(object):
                         img = train_transform(self._open_image(f"imgs_for_test/{img}"))
                         x0 = img.to(self.config.device).unsqueeze(0)
                     else:
-                        x0 = img.to(self.config.device)
+                        x0 = normalize(img.to(self.config.device))
                 # --------------------------------
 
                 if self.args.single_image and self.mode == 'train':
                     self.save(x0, f'{self.mode}_{self.step}_0_orig.png')
 
-                x = x0.clone()
-
                 # Inversion of the real image
-                x = self.apply_diffusion(x=x,
-                                         seq_prev=self.seq_inv_next[1:],
-                                         seq_next=self.seq_inv[1:],
-                                         is_grad=False,
-                                         simple=is_stoch)
+                x = self.invert(x0, is_stoch=is_stoch)
                 x_lat = x.clone()
 
                 # Generation from computed latent variable
@@ -231,10 +304,15 @@ class EffDiff(object):
 
             self.img_lat_pairs_dic[self.mode] = img_lat_pairs
             pairs_path = os.path.join('precomputed/',
-                                      f'{self.config.data.category}_{self.mode}_t{self.args.t_0}_nim{self.args.n_precomp_img}_ninv{self.args.n_inv_step}_pairs.pth')
+                                      f'{self.config.data.category}_{self.mode}_t{self.args.t_0}_nim{self.args.n_precomp_img}_ninv{self.args.n_inv_step}{self._inv_suffix()}_pairs.pth')
             torch.save(img_lat_pairs, pairs_path)
             # --------------------------------------------------
 
+        # CLIP features of the source images are computed once,
+        # the training steps only encode the generated images
+        if hasattr(self, 'clip_loss_func'):
+            self.img_lat_pairs_dic['train'] = self._add_src_features(self.img_lat_pairs_dic['train'])
+
     # Fine tune the model
     # ----------------------------------------------------------------------------------
     def clip_finetune(self):
@@ -242,8 +320,22 @@ class EffDiff(object):
         print(f'   {self.src_txts}')
         print(f'-> {self.trg_image_paths}')
 
+        self._conf_loss()
+
         self.precompute_latents()
 
+        # The pairs are kept on the device if they fit, otherwise
+        # they are pinned and copied one step ahead of their use.
+        # Stacked training pairs are batched and shuffled on the device
+        budget = int(self.args.pairs_device_budget * 1024 ** 3)
+        for mode, pairs in self.img_lat_pairs_dic.items():
+            if mode == 'train' and self.args.stack_train_pairs:
+                self.img_lat_pairs_dic[mode] = PairStore(pairs, self.device, stack=True,
+                                                         batch_size=self.args.bs_train,
+                                                         shuffle=self.args.shuffle_train)
+            else:
+                self.img_lat_pairs_dic[mode] = PairStore(pairs, self.device, budget)
+
         print("Start finetuning")
         print(f"Sampling type: {self.args.sample_type.upper()} with eta {self.args.eta}")
 
@@ -252,6 +344,17 @@ class EffDiff(object):
 
             self.clip_loss_func.target_direction = None
 
+            # The reference image is loaded once per target, not at every step.
+            # A folder of references sets the direction to the mean of their features
+            ref_path = f"imgs_for_test/{self.trg_image_path}"
+            if os.path.isdir(ref_path):
+                with torch.no_grad():
+                    self.clip_loss_func.target_direction = \
+                        self.clip_loss_func.compute_reference_direction(self.src_txt, ref_path)
+                self.img_ref_vec = None
+            else:
+                self.img_ref_vec = self._load_test_image(ref_path)
+
             for self.it_out in range(self.args.n_iter):
 
                 # Single training steps
@@ -266,13 +369,13 @@ class EffDiff(object):
     # Single training epoch
     # ----------------------------------------------------------------------------------
     def train(self):
-        for self.step, (x0, x_id, x_lat) in enumerate(self.img_lat_pairs_dic['train']):
+        for self.step, (x0, x_id, x_lat, src_features, src_id_features) in enumerate(self.img_lat_pairs_dic['train']):
             self.model.train()
 
             time_in_start = time.time()
 
             self.optim_ft.zero_grad()
-            x = x_lat.clone().to(self.device)
+            x = x_lat.clone()
 
             # Single step estimation of the real object
             x = self.apply_diffusion(x=x,
@@ -284,29 +387,26 @@ class EffDiff(object):
                                      is_one_step=True)
 
             # Losses
-            x_source = x0.to(self.device)
-            train_transform = tfs.Compose([tfs.ToTensor(),
-                                           tfs.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5),
-                                                          inplace=True)])
-            img_ref = train_transform(self._open_image(f"imgs_for_test/{self.trg_image_path}"))
-            img_ref_vec = img_ref.to(self.config.device).unsqueeze(0)
-            loss_clip = (2 - self.clip_loss_func(x_source, self.src_txt, x, img_ref_vec)) / 2
+            x_source = x0
+            loss_clip = (2 - self.clip_loss_func(x_source, self.src_txt, x, self.img_ref_vec,
+                                                 src_features=src_features)) / 2
             loss_clip = -torch.log(loss_clip)
             loss_id = 0
-            loss_l1 = nn.L1Loss()(x0.to(self.device), x)
-            # loss = self.args.clip_loss_w * loss_clip + self.args.id_loss_w * loss_id + self.args.l1_loss_w * loss_l1
-            loss = self.args.clip_loss_w * loss_clip + self.args.l1_loss_w * loss_l1
+            if self.id_loss_func is not None:
+                loss_id = self.id_loss_func(x0, x, src_id_features).mean()
+            loss_l1 = nn.L1Loss()(x0, x)
+            loss = self.args.clip_loss_w * loss_clip + self.args.id_loss_w * loss_id + self.args.l1_loss_w * loss_l1
 
             loss.backward()
 
             self.optim_ft.step()
             time_in_end = time.time()
 
-            print(f"CLIP {self.step}-{self.it_out}: loss_l1: {loss_l1:.3f}, loss_clip: {loss_clip:.3f}")
+            print(f"CLIP {self.step}-{self.it_out}: loss_id: {loss_id:.3f}, loss_l1: {loss_l1:.3f}, loss_clip: {loss_clip:.3f}")
             print(f"Training for {len(x)} image(s) takes {time_in_end - time_in_start:.4f}s")
 
             if self.args.single_image:
-                x = x_lat.clone().to(self.device)
+                x = x_lat.clone()
                 self.model.eval()
                 x = self.apply_diffusion(x=x,
                                          seq_prev=reversed(self.seq_train),
@@ -334,7 +434,7 @@ class EffDiff(object):
         self.model.eval()
         for self.step, (x0, x_id, x_lat) in enumerate(self.img_lat_pairs_dic['test']):
 
-            x = self.apply_diffusion(x=x_lat.to(self.device),
+            x = self.apply_diffusion(x=x_lat,
                                      seq_prev=reversed(self.seq_train),
                                      seq_next=reversed(self.seq_train_next),
                                      sample_type=self.args.sample_type,
@@ -355,30 +455,228 @@ class EffDiff(object):
         self.is_first = False
     # ----------------------------------------------------------------------------------
 
+    # Editing of a single image with a fine-tuned model
+    # ----------------------------------------------------------------------------------
+    @torch.no_grad()
+    def edit_one_image(self):
+        x0 = self._load_test_image(self.args.img_path)
+        self.save(x0, '0_orig.png')
+
+        # Inversion uses the original model only
+        self.model.eval()
+        x_lat = self.invert(x0, is_stoch=not self.args.deterministic_inv)
+
+        model_ft = self._load_model(self.args.edit_model_path)
+        if self.args.model_ratios:
+            xs = self.sweep_model_ratio(x_lat, model_ft, self.args.model_ratios)
+            for ratio, x in zip(self.args.model_ratios, xs.split(len(x_lat))):
+                self.save(x, self._edit_name(self.args.edit_model_path, ratio))
+            return
+
+        x = self._generate(x_lat, model_ft, self.args.model_ratio)
+
+        self.save(x, self._edit_name(self.args.edit_model_path))
+    # ----------------------------------------------------------------------------------
+
+    # Generation for several degrees of change in a single pass,
+    # each model is evaluated once per step on the batch of all ratios
+    # ----------------------------------------------------------------------------------
+    @torch.no_grad()
+    def sweep_model_ratio(self, x_lat, model_ft, ratios):
+        n = len(x_lat)
+        x = x_lat.repeat(len(ratios), *([1] * (x_lat.dim() - 1)))
+        ratio = torch.tensor(ratios, dtype=x.dtype, device=x.device).repeat_interleave(n)
+        return self._generate(x, model_ft, ratio)
+    # ----------------------------------------------------------------------------------
+
+    # Editing of a single image with several fine-tuned models,
+    # the image is inverted once and all the edits start from its latent
+    # ----------------------------------------------------------------------------------
+    @torch.no_grad()
+    def edit_gallery(self, x0=None, edit_model_paths=None):
+        if x0 is None:
+            x0 = self._load_test_image(self.args.img_path)
+        if edit_model_paths is None:
+            edit_model_paths = self.args.edit_model_paths
+
+        self.model.eval()
+        x_lat = self.invert(x0, is_stoch=not self.args.deterministic_inv)
+
+        # Checkpoints are full state dicts, so they are applied back-to-back
+        # with a single resident model whose weights are swapped in place
+        model_ft = None
+        gallery = {}
+        for path in edit_model_paths:
+            time_in_start = time.time()
+            model_ft = self._load_model(path, model=model_ft)
+            gallery[path] = self._generate(x_lat, model_ft, self.args.model_ratio)
+            print(f"Edit {path} takes {time.time() - time_in_start:.4f}s")
+
+        return gallery
+
+    def save_gallery(self, gallery):
+        for path, x in gallery.items():
+            self.save(x, self._edit_name(path))
+        self.save(torch.cat(list(gallery.values()), dim=0), 'gallery.png', per_image=False)
+        self.writer.flush()
+    # ----------------------------------------------------------------------------------
+
+    # Editing of a folder of any size with a fine-tuned model. Images are decoded
+    # in the loader workers and edited in batches of bs_test, outputs are written
+    # in the background by the image writer. Images whose output exists are
+    # skipped, so an interrupted run is resumed by running the same command again
+    # ----------------------------------------------------------------------------------
+    @torch.no_grad()
+    def edit_folder(self, input_dir=None, output_dir=None, edit_model_path=None):
+        from torch.utils.data import DataLoader
+        from datasets.folder_dataset import get_folder_dataset, list_images
+
+        input_dir = input_dir or self.args.input_dir
+        output_dir = output_dir or self.args.output_dir or self.args.image_folder
+        edit_model_path = edit_model_path or self.args.edit_model_path
+        os.makedirs(output_dir, exist_ok=True)
+
+        paths = list_images(input_dir)
+        todo = [p for p in paths if not os.path.exists(self._folder_out_path(output_dir, p))]
+        print(f"Editing {len(todo)} of {len(paths)} images from {input_dir} to {output_dir}")
+        if not todo:
+            return
+
+        dataset = get_folder_dataset(todo, self.config, align_face=self.args.align_face)
+        loader = DataLoader(dataset, batch_size=self.args.bs_test, shuffle=False,
+                            num_workers=self.config.data.num_workers, pin_memory=True)
+
+        self.model.eval()
+        model_ft = self._load_model(edit_model_path)
+
+        n_done = 0
+        for x0, names in loader:
+            time_in_start = time.time()
+            x_lat = self.invert(x0.to(self.device, non_blocking=True),
+                                is_stoch=not self.args.deterministic_inv)
+            x = self._generate(x_lat, model_ft, self.args.model_ratio)
+
+            for x_i, name in zip(x.split(1), names):
+                self.writer.write(x_i, self._folder_out_path(output_dir, name))
+
+            n_done += len(names)
+            print(f"{n_done}/{len(todo)}: batch of {len(names)} takes {time.time() - time_in_start:.4f}s")
+
+        self.writer.flush()
+
+    def _folder_out_path(self, output_dir, path):
+        # the source extension stays in the name, a.jpg and a.png give a.jpg.png and a.png.png
+        return os.path.join(output_dir, os.path.basename(path)) + self.writer.ext
+    # ----------------------------------------------------------------------------------
+
+    # Editing of in-memory images, nothing is read from or written to disk
+    # ----------------------------------------------------------------------------------
+    @torch.no_grad()
+    def edit(self, images, edit_model, model_ratio=None, batch_size=8):
+        """Edits `images`, a (N, 3, H, W) tensor in [-1, 1], a PIL image or a
+        list of PIL images and (3, H, W) tensors, with `edit_model`, the path
+        of a fine-tuned checkpoint or a loaded model. PIL images are used as
+        they are, faces should be aligned beforehand. Returns the (N, 3, H, W)
+        edited images in [-1, 1] on the device of the runner."""
+        if model_ratio is None:
+            model_ratio = self.args.model_ratio
+        if isinstance(edit_model, str):
+            edit_model = self._load_model(edit_model)
+
+        self.model.eval()
+        xs = []
+        for x0 in self._to_batch(images).split(batch_size):
+            x_lat = self.invert(x0.to(self.device), is_stoch=not self.args.deterministic_inv)
+            xs.append(self._generate(x_lat, edit_model, model_ratio))
+        return torch.cat(xs, dim=0)
+    # ----------------------------------------------------------------------------------
+
     ####################################################################################
     # UTILS FUNCTIONS
 
+    # Generation from a latent with a fine-tuned model
+    # ----------------------------------------------------------------------------------
+    def _generate(self, x_lat, model_ft, ratio):
+        return self.apply_diffusion(x=x_lat,
+                                    seq_prev=reversed(self.seq_test),
+                                    seq_next=reversed(self.seq_test_next),
+                                    sample_type=self.args.sample_type,
+                                    eta=self.args.eta,
+                                    is_grad=False,
+                                    models=[self.model, model_ft],
+                                    ratio=ratio)
+
+    def _edit_name(self, edit_model_path, ratio=None):
+        if ratio is None:
+            ratio = self.args.model_ratio
+        model_name = edit_model_path.split('/')[-1].replace('.pth', '')
+        return f'3_gen_t{self.args.t_0}_it0_ninv{self.args.n_inv_step}_ngen{self.args.n_test_step}' \
+               f'_mrat{ratio}_{model_name}.png'
+
+    def _load_test_image(self, path):
+        return self._to_batch(self._open_image(path)).to(self.device)
+
+    def _to_batch(self, images):
+        if isinstance(images, torch.Tensor):
+            return images if images.dim() == 4 else images.unsqueeze(0)
+        if isinstance(images, Image.Image):
+            images = [images]
+
+        train_transform = tfs.Compose([tfs.Resize((256, 256)),
+                                       tfs.ToTensor(),
+                                       tfs.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5),
+                                                     inplace=True)])
+        return torch.stack([img.cpu() if isinstance(img, torch.Tensor) else train_transform(img.convert('RGB'))
+                            for img in images])
+    # ----------------------------------------------------------------------------------
+
     # Preparation of sequences
     # ----------------------------------------------------------------------------------
     def _conf_seqs(self):
-        seq_inv = np.linspace(0, 1, self.args.n_inv_step) * self.args.t_0
-        self.seq_inv = [int(s) for s in list(seq_inv)]
+        self.seq_inv = get_timestep_seq(self.args.n_inv_step, self.args.t_0, self.args.skip_type)
         self.seq_inv_next = [-1] + list(self.seq_inv[:-1])
 
         if self.args.n_train_step != 0:
-            seq_train = np.linspace(0, 1, self.args.n_train_step) * self.args.t_0
-            self.seq_train = [int(s) for s in list(seq_train)]
-            print('Uniform skip type')
+            self.seq_train = get_timestep_seq(self.args.n_train_step, self.args.t_0, self.args.skip_type)
+            print(f'{self.args.skip_type.capitalize()} skip type')
         else:
             self.seq_train = list(range(self.args.t_0))
             print('No skip')
         self.seq_train_next = [-1] + list(self.seq_train[:-1])
 
-        self.seq_test = np.linspace(0, 1, self.args.n_test_step) * self.args.t_0
-        self.seq_test = [int(s) for s in list(self.seq_test)]
+        self.seq_test = get_timestep_seq(self.args.n_test_step, self.args.t_0, self.args.skip_type)
         self.seq_test_next = [-1] + list(self.seq_test[:-1])
     # ----------------------------------------------------------------------------------
 
+    # CLIP and ArcFace features of the source images, stored next to their latents,
+    # the ArcFace features are empty when the identity loss is not used
+    # ----------------------------------------------------------------------------------
+    def _add_src_features(self, pairs):
+        featured = []
+        for pair in pairs:
+            x0 = pair[0].to(self.device)
+            clip_features = self.clip_loss_func.get_image_features(x0)
+            if self.id_loss_func is not None:
+                id_features = self.id_loss_func.extract_feats(x0)
+            else:
+                id_features = x0.new_zeros(len(x0), 0)
+            featured.append(list(pair[:3]) + [clip_features.cpu(), id_features.cpu()])
+        return featured
+    # ----------------------------------------------------------------------------------
+
+    # Latents of non-default inversion samplers or feature caching are stored separately
+    # ----------------------------------------------------------------------------------
+    def _inv_suffix(self):
+        suffix = ''
+        if self.args.inv_sample_type != 'ddim':
+            suffix += f'_{self.args.inv_sample_type}'
+        if self.args.skip_type != 'uniform':
+            suffix += f'_{self.args.skip_type}'
+        if self.args.cache_interval > 1:
+            suffix += f'_ci{self.args.cache_interval}_cb{self.args.cache_branch}'
+        return suffix
+    # ----------------------------------------------------------------------------------
+
     # Configuration of the diffusion model
     # ----------------------------------------------------------------------------------
     def _conf_model(self):
@@ -397,30 +695,83 @@ class EffDiff(object):
             raise ValueError
 
         if self.config.data.dataset in ["CelebA_HQ", "LSUN"]:
-            model = DDPM(self.config)
-            if self.args.model_path:
-                init_ckpt = torch.load(self.args.model_path)
-            else:
-                init_ckpt = torch.hub.load_state_dict_from_url(url, map_location=self.device)
+            path = self.args.model_path
             self.learn_sigma = False
-            print("Original diffusion Model loaded.")
         elif self.config.data.dataset in ["FFHQ", "AFHQ", "IMAGENET"]:
-            model = i_DDPM(self.config.data.dataset)
-            if self.args.model_path:
-                init_ckpt = torch.load(self.args.model_path)
-            else:
-                init_ckpt = torch.load(MODEL_PATHS[self.config.data.dataset])
+            path = self.args.model_path or MODEL_PATHS[self.config.data.dataset]
             self.learn_sigma = True
-            print("Improved diffusion Model loaded.")
         else:
             print('Not implemented dataset')
             raise ValueError
-        model.load_state_dict(init_ckpt)
 
-        model.to(self.device)
+        if path:
+            self.model_digest = file_digest(path)
+        else:
+            self.model_digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+        # A tensor file converted from the current checkpoint is memory-mapped instead
+        if path and not is_tensor_file(path):
+            path = converted_path(path) or path
+
+        # Base weights in shared memory are mapped by all the workers of the node
+        self.shared_base_path = None
+        if self.args.shared_weights_dir:
+            from utils.shared_weights import publish
+
+            if not path:
+                path = os.path.join(torch.hub.get_dir(), 'checkpoints', os.path.basename(url))
+                if not os.path.exists(path):
+                    torch.hub.download_url_to_file(url, path)
+            path = publish(path, self.args.shared_weights_dir)
+            self.shared_base_path = path
+
+        if path and is_tensor_file(path):
+            model = load_model(self._build_model, path, self.device)
+        else:
+            if path:
+                init_ckpt = torch.load(path, map_location='cpu')
+            else:
+                init_ckpt = torch.hub.load_state_dict_from_url(url, map_location='cpu')
+            model = self._build_model()
+            model.load_state_dict(init_ckpt)
+            model.to(self.device)
+
+        if self.learn_sigma:
+            print("Improved diffusion Model loaded.")
+        else:
+            print("Original diffusion Model loaded.")
         self.model = model
     # ----------------------------------------------------------------------------------
 
+    # Architecture of the diffusion model
+    # ----------------------------------------------------------------------------------
+    def _build_model(self):
+        if self.config.data.dataset in ["CelebA_HQ", "LSUN"]:
+            return DDPM(self.config)
+        elif self.config.data.dataset in ["FFHQ", "AFHQ", "IMAGENET"]:
+            return i_DDPM(self.config.data.dataset)
+        else:
+            print('Not implemented dataset')
+            raise ValueError
+    # ----------------------------------------------------------------------------------
+
+    # Loading of a fine-tuned model
+    # ----------------------------------------------------------------------------------
+    def _load_model(self, path, model=None):
+        if is_delta_file(path):
+            assert self.shared_base_path is not None, 'Delta checkpoints require --shared_weights_dir'
+            from utils.shared_weights import attach
+
+            return attach(self._build_model, self.shared_base_path, path).to(self.device)
+        if self.checkpoints is not None:
+            return self.checkpoints.get(path, self._build_model)
+        if model is None:
+            model = self._build_model().to(self.device)
+        model.load_state_dict(load_state(path))
+        model.eval()
+        return model
+    # ----------------------------------------------------------------------------------
+
     # Configuration of the optimizer
     # ----------------------------------------------------------------------------------
     def _conf_opt(self):
@@ -440,6 +791,8 @@ class EffDiff(object):
     # Configuration of the loss
     # ----------------------------------------------------------------------------------
     def _conf_loss(self):
+        from losses.clip_loss import CLIPLoss
+
         print("Loading losses")
         self.clip_loss_func = CLIPLoss(
             self.device,
@@ -448,8 +801,17 @@ class EffDiff(object):
             lambda_global=0,
             lambda_manifold=0,
             lambda_texture=0,
-            clip_model=self.args.clip_model_name)
-        #self.id_loss_func = id_loss.IDLoss().to(self.device).eval()
+            clip_model=self.args.clip_model_name,
+            precision=self.args.clip_precision,
+            compile=self.args.compile_clip,
+            text_cache_dir=self.args.clip_text_cache_dir)
+
+        # ArcFace is only loaded when the identity loss is used
+        self.id_loss_func = None
+        if self.args.id_loss_w > 0:
+            from losses.id_loss import IDLoss
+
+            self.id_loss_func = IDLoss(precision=self.args.id_precision).to(self.device).eval()
     # ----------------------------------------------------------------------------------
 
     # ----------------------------------------------------------------------------------
@@ -458,9 +820,12 @@ class EffDiff(object):
         img = Image.open(path).convert('RGB').resize((256, 256))
         img.save(path)
         if self.args.align_face:
+            # a missing dlib or scipy fails loudly, only images without a face are used unaligned
+            from utils.align_utils import run_alignment
+
             try:
                 img = run_alignment(path, output_size=self.config.data.image_size)
-            except:
+            except Exception:
                 img = Image.open(path).convert('RGB').resize((256, 256))
 
             return img
@@ -469,8 +834,7 @@ class EffDiff(object):
             return img
     # ----------------------------------------------------------------------------------
 
-    @torch.no_grad()
-    def save(self, x, name):
-        tvu.save_image((x + 1) * 0.5, os.path.join(self.args.image_folder, name))
+    def save(self, x, name, per_image=None):
+        self.writer.write(x, os.path.join(self.args.image_folder, name), per_image)
 
     ####################################################################################
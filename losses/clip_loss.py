@@ -1,11 +1,17 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 import torchvision.transforms as transforms
-import numpy as np
 
 import clip
 from PIL import Image
 
 from utils.text_templates import imagenet_templates, part_templates, imagenet_templates_small
+from utils.latent_cache import LatentCache, content_digest
+from datasets.folder_dataset import list_images
+
+TEXT_CACHE_DIR = 'precomputed/clip_text'
 
 
 class DirectionLoss(torch.nn.Module):
@@ -27,12 +33,56 @@ class DirectionLoss(torch.nn.Module):
         
         return self.loss_func(x, y)
 
+_PRECISIONS = {'fp16': torch.float16, 'bf16': torch.bfloat16, 'fp32': torch.float32}
+
+
+def convert_weights(model: torch.nn.Module, dtype: torch.dtype):
+    """clip.model.convert_weights for any dtype, layer norms stay in fp32."""
+
+    def _convert_weights(l):
+        if isinstance(l, (torch.nn.Conv1d, torch.nn.Conv2d, torch.nn.Linear)):
+            l.weight.data = l.weight.data.to(dtype)
+            if l.bias is not None:
+                l.bias.data = l.bias.data.to(dtype)
+
+        if isinstance(l, torch.nn.MultiheadAttention):
+            for attr in [*[f"{s}_proj_weight" for s in ["in", "q", "k", "v"]], "in_proj_bias", "bias_k", "bias_v"]:
+                tensor = getattr(l, attr)
+                if tensor is not None:
+                    tensor.data = tensor.data.to(dtype)
+
+        for name in ["text_projection", "proj"]:
+            if hasattr(l, name):
+                attr = getattr(l, name)
+                if attr is not None:
+                    attr.data = attr.data.to(dtype)
+
+    model.apply(_convert_weights)
+
+
+def load_frozen(name, device, precision='fp16', compile=False):
+    """CLIP model used as a fixed loss network: eval mode, no parameter gradients,
+    weights in `precision` on GPUs, the image encoder optionally compiled.
+    Gradients still flow to the input images."""
+    # loaded in fp32 on the CPU and converted once on the device
+    model, preprocess = clip.load(name, device='cpu')
+    model.to(device).eval().requires_grad_(False)
+
+    if torch.device(device).type == 'cuda':
+        convert_weights(model, _PRECISIONS[precision])
+    if compile and hasattr(torch, 'compile'):
+        model.visual = torch.compile(model.visual)
+    return model, preprocess
+
+
 class CLIPLoss(torch.nn.Module):
-    def __init__(self, device, lambda_direction=1., lambda_patch=0., lambda_global=0., lambda_manifold=0., lambda_texture=0., patch_loss_type='mae', direction_loss_type='cosine', clip_model='ViT-B/32'):
+    def __init__(self, device, lambda_direction=1., lambda_patch=0., lambda_global=0., lambda_manifold=0., lambda_texture=0., patch_loss_type='mae', direction_loss_type='cosine', clip_model='ViT-B/32', precision='fp16', compile=False, text_cache_dir=None):
         super(CLIPLoss, self).__init__()
 
         self.device = device
-        self.model, clip_preprocess = clip.load(clip_model, device=self.device)
+        self.clip_model_name = clip_model
+        self.precision = precision
+        self.model, clip_preprocess = load_frozen(clip_model, self.device, precision, compile)
 
         self.clip_preprocess = clip_preprocess
         
@@ -43,6 +93,10 @@ class CLIPLoss(torch.nn.Module):
         self.target_direction      = None
         self.patch_text_directions = None
 
+        # Encoded prompts by model, template set and prompt, and mean features of
+        # reference images by set of files, on disk if text_cache_dir is given
+        self.text_cache = LatentCache(256, text_cache_dir)
+
         self.patch_loss     = DirectionLoss(patch_loss_type)
         self.direction_loss = DirectionLoss(direction_loss_type)
         self.patch_direction_loss = torch.nn.CosineSimilarity(dim=2)
@@ -57,10 +111,12 @@ class CLIPLoss(torch.nn.Module):
         self.target_text_features = None
         self.angle_loss = torch.nn.L1Loss()
 
-        self.model_cnn, preprocess_cnn = clip.load("RN50", device=self.device)
-        self.preprocess_cnn = transforms.Compose([transforms.Normalize(mean=[-1.0, -1.0, -1.0], std=[2.0, 2.0, 2.0])] + # Un-normalize from [-1.0, 1.0] (GAN output) to [0, 1].
-                                        preprocess_cnn.transforms[:2] +                                                 # to match CLIP input scale assumptions
-                                        preprocess_cnn.transforms[4:])                                                  # + skip convert PIL to tensor
+        # the CNN is only used by the texture loss
+        if self.lambda_texture:
+            self.model_cnn, preprocess_cnn = load_frozen("RN50", self.device, precision, compile)
+            self.preprocess_cnn = transforms.Compose([transforms.Normalize(mean=[-1.0, -1.0, -1.0], std=[2.0, 2.0, 2.0])] + # Un-normalize from [-1.0, 1.0] (GAN output) to [0, 1].
+                                            preprocess_cnn.transforms[:2] +                                                 # to match CLIP input scale assumptions
+                                            preprocess_cnn.transforms[4:])                                                  # + skip convert PIL to tensor
 
         self.texture_loss = torch.nn.MSELoss()
 
@@ -88,11 +144,20 @@ class CLIPLoss(torch.nn.Module):
         return 1. - similarity
     
     def get_text_features(self, class_str: str, templates=imagenet_templates, norm: bool = True) -> torch.Tensor:
-        template_text = self.compose_text_with_templates(class_str, templates)
+        # the dtype actually used, fp32 on the CPU whatever precision was requested
+        key = self.text_cache.key(self.clip_model_name, self.model.dtype, '|'.join(templates), class_str)
+        text_features = self.text_cache.get(key)
+
+        if text_features is None:
+            template_text = self.compose_text_with_templates(class_str, templates)
 
-        tokens = clip.tokenize(template_text).to(self.device)
+            tokens = clip.tokenize(template_text).to(self.device)
 
-        text_features = self.encode_text(tokens).detach()
+            text_features = self.encode_text(tokens).detach()
+            self.text_cache.put(key, text_features)
+        else:
+            # a copy, the cached features are normalized in place below
+            text_features = text_features.to(self.device, copy=True)
 
         if norm:
             text_features /= text_features.norm(dim=-1, keepdim=True)
@@ -119,29 +184,60 @@ class CLIPLoss(torch.nn.Module):
 
         return text_direction
 
-    def compute_img2img_direction(self, source_images: torch.Tensor, target_images: list) -> torch.Tensor:
+    def compute_reference_direction(self, source_class: str, target_images) -> torch.Tensor:
+        source_features = self.get_text_features(source_class)
+        target_features = self.get_reference_features(target_images)
+
+        direction = (target_features - source_features).mean(axis=0, keepdim=True)
+        direction = direction / direction.norm(dim=-1, keepdim=True)
+
+        return direction
+
+    def compute_img2img_direction(self, source_images: torch.Tensor, target_images: list, batch_size: int = 32) -> torch.Tensor:
         with torch.no_grad():
 
             src_encoding = self.get_image_features(source_images)
             src_encoding = src_encoding.mean(dim=0, keepdim=True)
 
-            target_encodings = []
-            for target_img in target_images:
-                preprocessed = self.clip_preprocess(Image.open(target_img)).unsqueeze(0).to(self.device)
-                
-                encoding = self.model.encode_image(preprocessed)
-                encoding /= encoding.norm(dim=-1, keepdim=True)
-
-                target_encodings.append(encoding)
-            
-            target_encoding = torch.cat(target_encodings, axis=0)
-            target_encoding = target_encoding.mean(dim=0, keepdim=True)
+            target_encoding = self.get_reference_features(target_images, batch_size)
 
             direction = target_encoding - src_encoding
             direction /= direction.norm(dim=-1, keepdim=True)
 
         return direction
 
+    def get_reference_features(self, target_images, batch_size: int = 32, num_workers: int = 8) -> torch.Tensor:
+        """Mean of the normalized CLIP features of reference image files, or of every image
+        file of a folder. The images are decoded in parallel and encoded in batches, the mean is
+        cached by the contents of the files."""
+        if isinstance(target_images, str):
+            # only the image files, notes or .DS_Store of the folder are skipped
+            folder = target_images
+            target_images = list_images(folder)
+            if not target_images:
+                raise ValueError(f'No reference images in {folder}')
+
+        key = self.text_cache.key(self.clip_model_name, self.model.dtype,
+                                  *sorted(content_digest(path) for path in target_images))
+        target_encoding = self.text_cache.get(key)
+        if target_encoding is not None:
+            return target_encoding.to(self.device)
+
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            preprocessed = list(pool.map(lambda path: self.clip_preprocess(Image.open(path)), target_images))
+
+        target_encodings = []
+        with torch.no_grad():
+            for i in range(0, len(preprocessed), batch_size):
+                batch = torch.stack(preprocessed[i:i + batch_size]).to(self.device)
+                encoding = self.model.encode_image(batch)
+                encoding /= encoding.norm(dim=-1, keepdim=True)
+                target_encodings.append(encoding)
+
+        target_encoding = torch.cat(target_encodings, axis=0).mean(dim=0, keepdim=True)
+        self.text_cache.put(key, target_encoding)
+        return target_encoding
+
     def set_text_features(self, source_class: str, target_class: str) -> None:
         source_features = self.get_text_features(source_class).mean(axis=0, keepdim=True)
         self.src_text_features = source_features / source_features.norm(dim=-1, keepdim=True)
@@ -170,12 +266,16 @@ class CLIPLoss(torch.nn.Module):
     def compose_text_with_templates(self, text: str, templates=imagenet_templates) -> list:
         return [template.format(text) for template in templates]
             
-    def clip_directional_loss(self, src_img: torch.Tensor, source_class: str, target_img: torch.Tensor, target_class: torch.Tensor) -> torch.Tensor:
+    def clip_directional_loss(self, src_img: torch.Tensor, source_class: str, target_img: torch.Tensor, target_class: torch.Tensor, src_features: torch.Tensor = None) -> torch.Tensor:
 
         if self.target_direction is None:
             self.target_direction = self.compute_text_direction(source_class, target_class)
 
-        src_encoding    = self.get_image_features(src_img)
+        # features of the source images may be precomputed, they never change during training
+        if src_features is not None:
+            src_encoding = src_features.to(self.device)
+        else:
+            src_encoding = self.get_image_features(src_img)
         target_encoding = self.get_image_features(target_img)
 
         edit_direction = (target_encoding - src_encoding)
@@ -199,8 +299,8 @@ class CLIPLoss(torch.nn.Module):
         batch_size, channels, height, width = img_shape
 
         half_size = size // 2
-        patch_centers = np.concatenate([np.random.randint(half_size, width - half_size,  size=(batch_size * num_patches, 1)),
-                                        np.random.randint(half_size, height - half_size, size=(batch_size * num_patches, 1))], axis=1)
+        patch_centers = torch.stack([torch.randint(half_size, width - half_size,  (batch_size * num_patches,), device=self.device),
+                                     torch.randint(half_size, height - half_size, (batch_size * num_patches,), device=self.device)], dim=1)
 
         return patch_centers
 
@@ -209,27 +309,20 @@ class CLIPLoss(torch.nn.Module):
         num_patches = len(patch_centers) // batch_size
         half_size   = size // 2
 
-        patches = []
-
-        for batch_idx in range(batch_size):
-            for patch_idx in range(num_patches):
+        # all the patches are gathered at once: (P, 1, 1) images, (P, size, 1) rows, (P, 1, size) columns
+        patch_centers = torch.as_tensor(patch_centers, device=img.device)
+        offsets = torch.arange(size, device=img.device) - half_size
+        batch_idx = torch.arange(batch_size, device=img.device).repeat_interleave(num_patches)
+        rows = patch_centers[:, 1, None] + offsets
+        cols = patch_centers[:, 0, None] + offsets
 
-                center_x = patch_centers[batch_idx * num_patches + patch_idx][0]
-                center_y = patch_centers[batch_idx * num_patches + patch_idx][1]
+        patches = img.permute(0, 2, 3, 1)[batch_idx[:, None, None], rows[:, :, None], cols[:, None, :]]
 
-                patch = img[batch_idx:batch_idx+1, :, center_y - half_size:center_y + half_size, center_x - half_size:center_x + half_size]
-
-                patches.append(patch)
-
-        patches = torch.cat(patches, axis=0)
-
-        return patches
+        return patches.permute(0, 3, 1, 2)
 
     def patch_scores(self, img: torch.Tensor, class_str: str, patch_centers, patch_size: int) -> torch.Tensor:
 
-        parts = self.compose_text_with_templates(class_str, part_templates)    
-        tokens = clip.tokenize(parts).to(self.device)
-        text_features = self.encode_text(tokens).detach()
+        text_features = self.get_text_features(class_str, part_templates, norm=False)
 
         patches        = self.generate_patches(img, patch_centers, patch_size)
         image_features = self.get_image_features(patches)
@@ -283,7 +376,7 @@ class CLIPLoss(torch.nn.Module):
 
         return self.texture_loss(src_features, target_features)
 
-    def forward(self, src_img: torch.Tensor, source_class: str, target_img: torch.Tensor, target_image_ref: torch.Tensor, texture_image: torch.Tensor = None):
+    def forward(self, src_img: torch.Tensor, source_class: str, target_img: torch.Tensor, target_image_ref: torch.Tensor, texture_image: torch.Tensor = None, src_features: torch.Tensor = None):
         # clip_loss = 0.0
 
         # if self.lambda_global:
@@ -293,7 +386,7 @@ class CLIPLoss(torch.nn.Module):
         #     clip_loss += self.lambda_patch * self.patch_directional_loss(src_img, source_class, target_img, target_image_ref)
 
         # if self.lambda_direction:
-        clip_loss = self.clip_directional_loss(src_img, source_class, target_img, target_image_ref)
+        clip_loss = self.clip_directional_loss(src_img, source_class, target_img, target_image_ref, src_features)
 
             # clip_loss += self.lambda_direction * self.clip_directional_loss(src_img, source_class, target_img, target_image_ref)
 
@@ -304,3 +397,27 @@ class CLIPLoss(torch.nn.Module):
         #     clip_loss += self.lambda_texture * self.cnn_feature_loss(texture_image, target_img)
 
         return clip_loss
+
+
+def warm_text_cache(clip_model, precision='fp16', cache_dir=TEXT_CACHE_DIR, device='cuda'):
+    """Encodes every prompt of utils/text_dic.py into the on-disk text cache."""
+    from utils.text_dic import SRC_TRG_TXT_DIC
+
+    clip_loss = CLIPLoss(device, clip_model=clip_model, precision=precision, text_cache_dir=cache_dir)
+    prompts = sorted({txt for src_txts, trg_txts in SRC_TRG_TXT_DIC.values() for txt in src_txts + trg_txts})
+    with torch.no_grad():
+        for prompt in prompts:
+            clip_loss.get_text_features(prompt)
+    print(f'{len(prompts)} prompts of {clip_model} in {cache_dir}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Encode the prompts of utils/text_dic.py into the CLIP text cache')
+    parser.add_argument('--clip_model_name', type=str, nargs='+', default=['ViT-B/16'], help='CLIP models to warm')
+    parser.add_argument('--clip_precision', type=str, default='fp16', help='fp16 | bf16 | fp32')
+    parser.add_argument('--cache_dir', type=str, default=TEXT_CACHE_DIR, help='Directory of the text cache')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    for name in args.clip_model_name:
+        warm_text_cache(name, args.clip_precision, args.cache_dir, device)
@@ -5,31 +5,35 @@ from models.insight_face.model_irse import Backbone, MobileFaceNet
 
 
 class IDLoss(nn.Module):
-    def __init__(self, use_mobile_id=False):
+    def __init__(self, use_mobile_id=False, precision='fp32'):
         super(IDLoss, self).__init__()
         print('Loading ResNet ArcFace')
         self.facenet = Backbone(input_size=112, num_layers=50, drop_ratio=0.6, mode='ir_se')
-        self.facenet.load_state_dict(torch.load(MODEL_PATHS['ir_se50']))
+        self.facenet.load_state_dict(torch.load(MODEL_PATHS['ir_se50'], map_location='cpu'))
 
         self.face_pool = torch.nn.AdaptiveAvgPool2d((112, 112))
+        # fixed loss network, gradients only flow to the images
+        self.facenet.eval().requires_grad_(False)
+        self.fp16 = precision == 'fp16'
+
+    def train(self, mode=True):
+        # the backbone stays in eval mode, its batch norms use the running statistics
+        super(IDLoss, self).train(mode)
         self.facenet.eval()
+        return self
 
     def extract_feats(self, x):
         x = x[:, :, 35:223, 32:220]  # Crop interesting region
         x = self.face_pool(x)
-        x_feats = self.facenet(x)
-        return x_feats
+        with torch.cuda.amp.autocast(enabled=self.fp16 and x.is_cuda):
+            x_feats = self.facenet(x)
+        return x_feats.float()
 
-    def forward(self, x, x_hat):
-        n_samples = x.shape[0]
-        x_feats = self.extract_feats(x)
+    def forward(self, x, x_hat, x_feats=None):
+        # features of the unchanged source images may be precomputed
+        if x_feats is None:
+            x_feats = self.extract_feats(x)
         x_feats = x_feats.detach()
 
         x_hat_feats = self.extract_feats(x_hat)
-        losses = []
-        for i in range(n_samples):
-            loss_sample = 1 - x_hat_feats[i].dot(x_feats[i])
-            losses.append(loss_sample.unsqueeze(0))
-
-        losses = torch.cat(losses, dim=0)
-        return losses
+        return 1 - (x_hat_feats * x_feats).sum(dim=1)
@@ -20,6 +20,8 @@ def parse_args_and_config():
     parser.add_argument('--clip_latent_optim', action='store_true')
     parser.add_argument('--edit_images_from_dataset', action='store_true')
     parser.add_argument('--edit_one_image', action='store_true')
+    parser.add_argument('--edit_gallery', action='store_true')
+    parser.add_argument('--edit_folder', action='store_true')
     parser.add_argument('--unseen2unseen', action='store_true')
     parser.add_argument('--clip_finetune_eff', action='store_true')
     parser.add_argument('--edit_one_image_eff', action='store_true')
@@ -37,6 +39,8 @@ def parse_args_and_config():
     parser.add_argument('--edit_attr', type=str, default=None, help='Attribute to edit defiend in ./utils/text_dic.py')
     parser.add_argument('--src_txts', type=str, action='append', help='Source text e.g. Face')
     parser.add_argument('--trg_txts', type=str, action='append', help='Target text e.g. Angry Face')
+    parser.add_argument('--trg_image_paths', type=str, default=None,
+                        help='Reference image, or folder of reference images, in ./imgs_for_test for --clip_finetune')
     parser.add_argument('--target_class_num', type=str, default=None)
 
     # Sampling
@@ -45,8 +49,17 @@ def parse_args_and_config():
     parser.add_argument('--n_train_step', type=int, default=6, help='# of steps during generative pross for train')
     parser.add_argument('--n_test_step', type=int, default=6, help='# of steps during generative pross for test')
     parser.add_argument('--sample_type', type=str, default='ddim',
-                        help='ddpm for Markovian sampling, ddim for non-Markovian sampling')
+                        help='ddpm for Markovian sampling, ddim for non-Markovian sampling, '
+                             'dpm2m / dpm3m for 2nd / 3rd order multistep solvers')
+    parser.add_argument('--inv_sample_type', type=str, default='ddim',
+                        help='Deterministic sampler used for inversion: ddim | dpm2m | dpm3m')
+    parser.add_argument('--skip_type', type=str, default='uniform',
+                        help='Spacing of the sampling timesteps: uniform | quad')
     parser.add_argument('--eta', type=float, default=0.0, help='Controls of varaince of the generative process')
+    parser.add_argument('--cache_interval', type=int, default=1,
+                        help='Run the full UNet every `cache_interval` steps and reuse its deep features in between')
+    parser.add_argument('--cache_branch', type=int, default=3,
+                        help='# of shallow UNet blocks recomputed on the steps with reused deep features')
 
     # Train & Test
     parser.add_argument('--single_image', type=int, default=0, help='Whether to do single image editing')
@@ -61,6 +74,12 @@ def parse_args_and_config():
                         help='Whether to save training results during CLIP fineuning')
     parser.add_argument('--bs_train', type=int, default=1, help='Training batch size during CLIP fineuning')
     parser.add_argument('--bs_test', type=int, default=1, help='Test batch size during CLIP fineuning')
+    parser.add_argument('--pairs_device_budget', type=float, default=1.0,
+                        help='GiB of precomputed image-latent pairs kept on the device, larger sets are prefetched')
+    parser.add_argument('--stack_train_pairs', type=int, default=0,
+                        help='Whether to stack all the training pairs on the device and train on batches of bs_train')
+    parser.add_argument('--shuffle_train', type=int, default=0,
+                        help='Whether to shuffle the stacked training pairs every iteration')
     parser.add_argument('--n_precomp_img', type=int, default=100, help='# of images to precompute latents')
     parser.add_argument('--n_train_img', type=int, default=50, help='# of training images')
     parser.add_argument('--n_test_img', type=int, default=10, help='# of test images')
@@ -72,12 +91,37 @@ def parse_args_and_config():
                         help='Whether to change multiple attributes by mixing multiple models')
     parser.add_argument('--model_ratio', type=float, default=1,
                         help='Degree of change, noise ratio from original and finetuned model.')
+    parser.add_argument('--model_ratios', type=float, nargs='+', default=None,
+                        help='Several degrees of change generated together by --edit_one_image')
+    parser.add_argument('--edit_model_path', type=str, default=None,
+                        help='Fine-tuned model applied by --edit_one_image')
+    parser.add_argument('--edit_model_paths', type=str, nargs='+', default=None,
+                        help='Fine-tuned models applied to the same image by --edit_gallery')
+    parser.add_argument('--input_dir', type=str, default=None, help='Folder of images edited by --edit_folder')
+    parser.add_argument('--output_dir', type=str, default=None,
+                        help='Output folder of --edit_folder, defaults to the image folder of the experiment')
+    parser.add_argument('--shared_weights_dir', type=str, default=None,
+                        help='Shared memory directory (e.g. /dev/shm/effdiff) holding one copy of the base weights per node')
+    parser.add_argument('--latent_cache_size', type=int, default=0,
+                        help='# of inverted latents kept in memory for repeated edits of the same image')
+    parser.add_argument('--latent_cache_dir', type=str, default=None,
+                        help='Directory of the on-disk tier of the latent cache')
+    parser.add_argument('--save_format', type=str, default='png', help='Format of the saved images: png | jpg | webp | npy')
+    parser.add_argument('--save_quality', type=int, default=-1,
+                        help='PNG compression level (0-9) or JPEG / WebP quality (1-100), -1 for the defaults')
+    parser.add_argument('--save_per_image', type=int, default=0,
+                        help='Whether to save the images of a batch as separate files instead of a grid')
 
     # Loss & Optimization
     parser.add_argument('--clip_loss_w', type=int, default=3, help='Weights of CLIP loss')
     parser.add_argument('--l1_loss_w', type=float, default=0, help='Weights of L1 loss')
     parser.add_argument('--id_loss_w', type=float, default=0, help='Weights of ID loss')
+    parser.add_argument('--id_precision', type=str, default='fp32', help='Precision of the ArcFace network of ID loss: fp16 | fp32')
     parser.add_argument('--clip_model_name', type=str, default='ViT-B/16', help='ViT-B/16, ViT-B/32, RN50x16 etc')
+    parser.add_argument('--clip_precision', type=str, default='fp16', help='Precision of the CLIP weights on GPU: fp16 | bf16 | fp32')
+    parser.add_argument('--compile_clip', type=int, default=0, help='Whether to compile the CLIP image encoder (torch>=2.0)')
+    parser.add_argument('--clip_text_cache_dir', type=str, default='precomputed/clip_text',
+                        help='Directory of the cache of encoded prompts, python -m losses.clip_loss warms it')
     parser.add_argument('--lr_clip_finetune', type=float, default=2e-6, help='Initial learning rate for finetuning')
     parser.add_argument('--lr_clip_lat_opt', type=float, default=2e-2, help='Initial learning rate for latent optim')
     parser.add_argument('--n_iter', type=int, default=1,
@@ -98,6 +142,10 @@ def parse_args_and_config():
         else:
             args.exp = args.exp + f'_FT_{new_config.data.category}_{args.trg_txts}_t{args.t_0}_ninv{args.n_inv_step}_ngen{args.n_train_step}_id{args.id_loss_w}_l1{args.l1_loss_w}_lr{args.lr_clip_finetune}'
 
+    elif args.edit_one_image or args.edit_gallery:
+        args.exp = args.exp + f'_E1_{new_config.data.category}_{args.img_path.split("/")[-1].split(".")[0]}_t{args.t_0}_ninv{args.n_inv_step}_ngen{args.n_test_step}'
+    elif args.edit_folder:
+        args.exp = args.exp + f'_EF_{new_config.data.category}_{args.edit_model_path.split("/")[-1].split(".")[0]}_t{args.t_0}_ninv{args.n_inv_step}_ngen{args.n_test_step}'
     elif args.recon_exp:
         args.exp = args.exp + f'_REC_{new_config.data.category}_{args.img_path.split("/")[-1].split(".")[0]}_t{args.t_0}_ninv{args.n_train_step}'
     elif args.find_best_image:
@@ -177,12 +225,20 @@ def main():
     try:
         if args.clip_finetune:
             runner.clip_finetune()
+        elif args.edit_one_image:
+            runner.edit_one_image()
+        elif args.edit_gallery:
+            runner.save_gallery(runner.edit_gallery())
+        elif args.edit_folder:
+            runner.edit_folder()
 
         else:
             print('Choose one mode!')
             raise ValueError
     except Exception:
         logging.error(traceback.format_exc())
+    finally:
+        runner.writer.close()
 
     return 0
 
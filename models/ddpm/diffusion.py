@@ -314,9 +314,15 @@ class DDPM(nn.Module):
                                         stride=1,
                                         padding=1)
 
-    def forward(self, x, t):
+    def forward(self, x, t, cache=None):
         assert x.shape[2] == x.shape[3] == self.resolution
 
+        # number of skip connections shared by the down and up paths
+        n_skips = 1 + self.num_resolutions * self.num_res_blocks + self.num_resolutions - 1
+        reuse = cache is not None and cache.reuse
+        branch = n_skips - cache.branch if cache is not None else -1
+        assert branch < n_skips
+
         # timestep embedding
         temb = get_timestep_embedding(t, self.ch)
         temb = self.temb.dense[0](temb)
@@ -326,24 +332,38 @@ class DDPM(nn.Module):
         # downsampling
         hs = [self.conv_in(x)]
         for i_level in range(self.num_resolutions):
+            if reuse and len(hs) >= cache.branch:
+                break
             for i_block in range(self.num_res_blocks):
+                if reuse and len(hs) >= cache.branch:
+                    break
                 h = self.down[i_level].block[i_block](hs[-1], temb)
                 if len(self.down[i_level].attn) > 0:
                     h = self.down[i_level].attn[i_block](h)
                 hs.append(h)
-            if i_level != self.num_resolutions - 1:
+            if i_level != self.num_resolutions - 1 and not (reuse and len(hs) >= cache.branch):
                 hs.append(self.down[i_level].downsample(hs[-1]))
             hs[-1] = log_bwd(hs[-1], msg=f'downsampling {i_level}')
 
         # middle
-        h = hs[-1]
-        h = self.mid.block_1(h, temb)
-        h = self.mid.attn_1(h)
-        h = self.mid.block_2(h, temb)
+        if not reuse:
+            h = hs[-1]
+            h = self.mid.block_1(h, temb)
+            h = self.mid.attn_1(h)
+            h = self.mid.block_2(h, temb)
 
         # upsampling
+        k = 0
         for i_level in reversed(range(self.num_resolutions)):
             for i_block in range(self.num_res_blocks + 1):
+                if k == branch:
+                    if reuse:
+                        h = cache.features
+                    else:
+                        cache.features = h.detach()
+                k += 1
+                if reuse and k <= branch:
+                    continue
                 h = log_bwd(h, msg=f'upsampling before i_level={i_level}, i_bloc={i_block} block')
                 cat = torch.cat([h, hs.pop()], dim=1)
                 cat = log_bwd(cat, msg=f'cat {h.shape, cat.shape}')
@@ -352,9 +372,9 @@ class DDPM(nn.Module):
                 if len(self.up[i_level].attn) > 0:
                     h = self.up[i_level].attn[i_block](h)
                     h = log_bwd(h, msg=f'upsampling for i_level={i_level}, i_bloc={i_block} attn')
-            if i_level != 0:
+            if i_level != 0 and not (reuse and k <= branch):
                 h = self.up[i_level].upsample(h)
-            h = log_bwd(h, msg=f'upsampling {i_level}')
+                h = log_bwd(h, msg=f'upsampling {i_level}')
 
         # end
         h = self.norm_out(h)
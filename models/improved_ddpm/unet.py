@@ -636,13 +636,16 @@ class UNetModel(nn.Module):
         self.middle_block.apply(convert_module_to_f32)
         self.output_blocks.apply(convert_module_to_f32)
 
-    def forward(self, x, timesteps, y=None, ref_img=None):
+    def forward(self, x, timesteps, y=None, ref_img=None, cache=None):
         """
         Apply the model to an input batch.
 
         :param x: an [N x C x ...] Tensor of inputs.
         :param timesteps: a 1-D batch of timesteps.
         :param y: an [N] Tensor of labels, if class-conditional.
+        :param cache: an optional DeepCache. If its features are to be
+                      reused, only the shallowest `cache.branch` input and
+                      output blocks are evaluated.
         :return: an [N x C x ...] Tensor of outputs.
         """
         # assert (y is not None) == (
@@ -656,12 +659,26 @@ class UNetModel(nn.Module):
         #     assert y.shape == (x.shape[0],)
         #     emb = emb + self.label_emb(y)
 
+        reuse = cache is not None and cache.reuse
+        branch = len(self.output_blocks) - cache.branch if cache is not None else -1
+        assert branch < len(self.output_blocks)
+
         h = x.type(self.dtype)
         for module in self.input_blocks:
+            if reuse and len(hs) >= cache.branch:
+                break
             h = module(h, emb)
             hs.append(h)
-        h = self.middle_block(h, emb)
-        for module in self.output_blocks:
+        if not reuse:
+            h = self.middle_block(h, emb)
+        for i, module in enumerate(self.output_blocks):
+            if i == branch:
+                if reuse:
+                    h = cache.features
+                else:
+                    cache.features = h.detach()
+            elif reuse and i < branch:
+                continue
             h = th.cat([h, hs.pop()], dim=1)
             h = module(h, emb)
         h = h.type(x.dtype)
@@ -17,10 +17,18 @@ from cog import BasePredictor, Path, Input
 
 from effdiff import EffDiff
 from main import dict2namespace
+from utils.latent_cache import LatentCache
+from utils.checkpoint_manager import CheckpointManager
 
 
 class Predictor(BasePredictor):
     def setup(self):
+        # Inverted latents are shared by all the edits of the same image. Uploads are
+        # arbitrary images, the unbounded disk tier is only used if LATENT_CACHE_DIR is set
+        self.latent_cache = LatentCache(max_items=64, cache_dir=os.environ.get("LATENT_CACHE_DIR"))
+        # Popular edits stay on the GPU, colder ones in pinned host memory
+        self.checkpoints = CheckpointManager("cuda:0", device_budget=8 * 1024 ** 3, host_budget=16 * 1024 ** 3)
+
         self.configs = {
             "ImageNet style transfer": "imagenet.yml",
             "Human face manipulation": "celeba.yml",
@@ -107,6 +115,34 @@ class Predictor(BasePredictor):
             ge=5,
             le=100,
         ),
+        n_inv_step: int = Input(
+            default=40,
+            ge=5,
+            le=100,
+            description="Number of inversion steps. Multistep solvers need far fewer steps than DDIM.",
+        ),
+        sample_type: str = Input(
+            default="ddim",
+            choices=["ddim", "dpm2m", "dpm3m"],
+            description="Deterministic sampler used for both inversion and generation.",
+        ),
+        skip_type: str = Input(
+            default="uniform",
+            choices=["uniform", "quad"],
+            description="Spacing of the sampling timesteps.",
+        ),
+        all_edits: bool = Input(
+            default=False,
+            description="Return a gallery of all the edits of the chosen manipulation that share"
+            " the inversion depth of the chosen edit. The image is inverted only once.",
+        ),
+        cache_interval: int = Input(
+            default=1,
+            ge=1,
+            le=10,
+            description="Run the full UNet every `cache_interval` steps and reuse its deep features in between."
+            " Applies to inversion and generation.",
+        ),
     ) -> Path:
         # sanity check
         assert edit_type.startswith(
@@ -123,16 +159,20 @@ class Predictor(BasePredictor):
 
         # Test arg, config
         align_face = 1 if manipulation == "Human face manipulation" else 0
-        n_inv_step = 40
         args_dic = {
             "config": self.configs[manipulation],
             "t_0": t_0,
             "n_inv_step": int(n_inv_step),
             "n_test_step": int(n_test_step),
-            "sample_type": "ddim",
+            "sample_type": sample_type,
+            "inv_sample_type": sample_type,
+            "skip_type": skip_type,
             "eta": 0.0,
+            "cache_interval": int(cache_interval),
+            "cache_branch": 3,
             "bs_test": 1,
-            "model_path": model_path,
+            "model_path": None,
+            "edit_model_path": model_path,
             "img_path": str(image),
             "deterministic_inv": 1,
             "hybrid_noise": 0,
@@ -140,9 +180,21 @@ class Predictor(BasePredictor):
             "align_face": align_face,
             "image_folder": exp_dir,
             "model_ratio": degree_of_change,
+            "model_ratios": None,
             "edit_attr": None,
             "src_txts": None,
             "trg_txts": None,
+            "trg_image_paths": None,
+            "n_train_step": int(n_test_step),
+            "lr_clip_finetune": 0.0,
+            "sch_gamma": 1.0,
+            "clip_model_name": "ViT-B/16",
+            "latent_cache_size": 0,
+            "latent_cache_dir": None,
+            "shared_weights_dir": None,
+            "save_format": "png",
+            "save_quality": -1,
+            "save_per_image": 0,
         }
         args = dict2namespace(args_dic)
 
@@ -152,14 +204,28 @@ class Predictor(BasePredictor):
         config.device = "cuda:0"
 
         # Edit
-        runner = EffDiff(args, config)
-        runner.edit_one_image()
-
-        out_image = Image.open(
-            f"{exp_dir}/3_gen_t{t_0}_it0_ninv{n_inv_step}_ngen{n_test_step}_mrat{degree_of_change}_{model_path.split('/')[-1].replace('.pth', '')}.png"
-        )
-        out_path = Path(tempfile.mkdtemp()) / "output.png"
-        out_image.save(str(out_path))
+        runner = EffDiff(args, config, latent_cache=self.latent_cache, checkpoints=self.checkpoints)
+        # the writer threads of every prediction are stopped with it
+        try:
+            if all_edits:
+                edit_model_paths = [
+                    os.path.join("checkpoint", path)
+                    for path in self.model_paths[manipulation].values()
+                    if path.endswith(f"_t{t_0}.pth")
+                ]
+                runner.save_gallery(runner.edit_gallery(edit_model_paths=edit_model_paths))
+                out_image = Image.open(f"{exp_dir}/gallery.png")
+            else:
+                runner.edit_one_image()
+                runner.writer.flush()
+                out_image = Image.open(
+                    f"{exp_dir}/3_gen_t{t_0}_it0_ninv{n_inv_step}_ngen{n_test_step}_mrat{degree_of_change}_{model_path.split('/')[-1].replace('.pth', '')}.png"
+                )
+            print(f"Checkpoints: {self.checkpoints.stats}")
+            out_path = Path(tempfile.mkdtemp()) / "output.png"
+            out_image.save(str(out_path))
+        finally:
+            runner.writer.close()
         shutil.rmtree(exp_dir)
 
         return out_path
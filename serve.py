@@ -0,0 +1,243 @@
+"""
+Local serving of the fine-tuned edits with dynamic batching.
+
+Requests are queued in front of a resident runner. Each request carries its
+own t_0, n_inv_step and n_test_step and is stepped on its own schedule:
+at every tick the active samples are grouped by the model their next step
+needs (the original model for inversion, a fine-tuned checkpoint for
+generation), and every group is advanced by one DDIM step with a vector of
+per-sample timesteps. New requests join the batch between ticks.
+
+Example:
+    python serve.py --config celeba.yml --edit_model_path checkpoint/human_pixar_t601.pth \
+                    --t_0 601 --img_paths imgs_for_test/girl.png imgs_for_test/man.png
+"""
+
+import os
+import time
+import asyncio
+import argparse
+
+import yaml
+import torch
+
+from effdiff import EffDiff
+from main import dict2namespace
+from utils.diffusion_utils import denoising_step, get_timestep_seq
+from utils.checkpoint_manager import CheckpointManager
+
+
+class EditRequest(object):
+    def __init__(self, x0, edit_model_path, t_0, n_inv_step, n_test_step, model_ratio, skip_type, future):
+        self.x = x0
+        self.edit_model_path = edit_model_path
+        self.model_ratio = model_ratio
+        self.future = future
+        self.latent_key = None
+
+        # (model, t, t_next) of every step, None stands for the original model
+        seq_inv = get_timestep_seq(n_inv_step, t_0, skip_type)
+        seq_inv_next = [-1] + list(seq_inv[:-1])
+        seq_test = get_timestep_seq(n_test_step, t_0, skip_type)
+        seq_test_next = [-1] + list(seq_test[:-1])
+
+        self.inv_schedule = [(None, i, j) for i, j in zip(seq_inv_next[1:], seq_inv[1:])]
+        self.gen_schedule = [(edit_model_path, i, j) for i, j in zip(reversed(seq_test), reversed(seq_test_next))]
+        self.schedule = self.inv_schedule + self.gen_schedule
+        self.pos = 0
+
+    def skip_inversion(self, x_lat):
+        self.x = x_lat
+        self.pos = len(self.inv_schedule)
+
+    @property
+    def is_inverted(self):
+        return self.pos == len(self.inv_schedule)
+
+    @property
+    def done(self):
+        return self.pos == len(self.schedule)
+
+    @property
+    def step(self):
+        return self.schedule[self.pos]
+
+
+class EditServer(object):
+    def __init__(self, runner, max_batch=8, max_wait=0.01):
+        self.runner = runner
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = None
+        self.active = []
+
+    def _queue(self):
+        # created on the running loop, before Python 3.10 a queue is bound to the loop current at its creation
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        return self.queue
+
+    async def submit(self, x0, edit_model_path, t_0, n_inv_step=40, n_test_step=6, model_ratio=1.0,
+                     skip_type='uniform'):
+        future = asyncio.get_running_loop().create_future()
+        request = EditRequest(x0.to(self.runner.device), edit_model_path, t_0, n_inv_step, n_test_step,
+                              model_ratio, skip_type, future)
+
+        # Repeated images skip the inversion
+        cache = self.runner.latent_cache
+        if cache is not None:
+            # the server inverts with plain DDIM steps, without DeepCache
+            request.latent_key = self.runner.latent_key(x0, t_0, n_inv_step, skip_type=skip_type,
+                                                        inv_sample_type='ddim', cache_interval=1)
+            x_lat = cache.get(request.latent_key)
+            if x_lat is not None:
+                request.skip_inversion(x_lat.to(self.runner.device))
+
+        await self._queue().put(request)
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        queue = self._queue()
+        while True:
+            if not self.active:
+                self.active.append(await queue.get())
+                # let concurrent requests arrive before the first tick
+                await asyncio.sleep(self.max_wait)
+            while not queue.empty() and len(self.active) < self.max_batch:
+                self.active.append(queue.get_nowait())
+
+            try:
+                inverted = await loop.run_in_executor(None, self.tick)
+            except Exception as e:
+                # the failed tick may have stepped part of the batch, fail every active request
+                # and keep serving the queued ones
+                for request in self.active:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                self.active = []
+                continue
+
+            # the cache is only touched from the event loop thread
+            for request in inverted:
+                self.runner.latent_cache.put(request.latent_key, request.x)
+
+            for request in [r for r in self.active if r.done]:
+                self.active.remove(request)
+                if not request.future.done():
+                    request.future.set_result(request.x)
+
+    @torch.no_grad()
+    def tick(self):
+        inverted = []
+        groups = {}
+        for request in self.active:
+            groups.setdefault(request.step[0], []).append(request)
+
+        for path, requests in groups.items():
+            x = torch.cat([r.x for r in requests], dim=0)
+            t = torch.tensor([r.step[1] for r in requests], dtype=torch.float, device=self.runner.device)
+            t_next = torch.tensor([r.step[2] for r in requests], dtype=torch.float, device=self.runner.device)
+
+            if path is None:
+                models, ratio = self.runner.model, 1.0
+            else:
+                models = [self.runner.model, self.runner._load_model(path)]
+                ratio = torch.tensor([r.model_ratio for r in requests], dtype=x.dtype, device=x.device)
+                if (ratio == 1.0).all():
+                    ratio = 1.0
+
+            x = denoising_step(x,
+                               t=t,
+                               t_next=t_next,
+                               models=models,
+                               logvars=self.runner.logvar,
+                               sampling_type='ddim',
+                               b=self.runner.betas,
+                               eta=0.0,
+                               learn_sigma=self.runner.learn_sigma,
+                               ratio=ratio)
+
+            for request, x_i in zip(requests, x.split(1)):
+                request.x = x_i
+                request.pos += 1
+                if request.is_inverted and request.latent_key is not None:
+                    inverted.append(request)
+
+        return inverted
+
+
+def build_runner(config_name, t_0=400, max_cached_latents=64, device_budget=8 * 1024 ** 3, host_budget=16 * 1024 ** 3):
+    args_dic = {
+        "config": config_name,
+        "t_0": t_0,
+        "n_inv_step": 40,
+        "n_train_step": 6,
+        "n_test_step": 6,
+        "sample_type": "ddim",
+        "inv_sample_type": "ddim",
+        "skip_type": "uniform",
+        "eta": 0.0,
+        "deterministic_inv": 1,
+        "model_ratio": 1.0,
+        "cache_interval": 1,
+        "cache_branch": 3,
+        "model_path": None,
+        "align_face": 0,
+        "image_folder": "runs/serve",
+        "src_txts": None,
+        "trg_image_paths": None,
+        "lr_clip_finetune": 0.0,
+        "sch_gamma": 1.0,
+        "clip_model_name": "ViT-B/16",
+        "latent_cache_size": max_cached_latents,
+        "latent_cache_dir": None,
+        "shared_weights_dir": None,
+        "save_format": "png",
+        "save_quality": -1,
+        "save_per_image": 0,
+    }
+    args = dict2namespace(args_dic)
+
+    with open(os.path.join("configs", args.config), "r") as f:
+        config = dict2namespace(yaml.safe_load(f))
+    config.device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+    checkpoints = CheckpointManager(config.device, device_budget, host_budget)
+    runner = EffDiff(args, config, checkpoints=checkpoints)
+    runner.model.eval()
+    return runner
+
+
+async def serve_images(server, img_paths, edit_model_path, t_0, n_inv_step, n_test_step):
+    server_task = asyncio.ensure_future(server.run())
+
+    async def edit(path):
+        x0 = server.runner._load_test_image(path)
+        time_in_start = time.time()
+        x = await server.submit(x0, edit_model_path, t_0, n_inv_step, n_test_step)
+        print(f"{path} edited in {time.time() - time_in_start:.4f}s")
+        server.runner.save(x, f'{os.path.splitext(os.path.basename(path))[0]}_edit.png')
+
+    await asyncio.gather(*[edit(path) for path in img_paths])
+    server.runner.writer.flush()
+    server_task.cancel()
+    print(f"Checkpoints: {server.runner.checkpoints.stats}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, required=True, help='Path to the config file')
+    parser.add_argument('--edit_model_path', type=str, required=True, help='Fine-tuned model to apply')
+    parser.add_argument('--img_paths', type=str, nargs='+', required=True, help='Images to edit concurrently')
+    parser.add_argument('--t_0', type=int, default=400, help='Return step in [0, 1000)')
+    parser.add_argument('--n_inv_step', type=int, default=40, help='# of steps for inversion')
+    parser.add_argument('--n_test_step', type=int, default=6, help='# of steps for generation')
+    parser.add_argument('--max_batch', type=int, default=8, help='Max # of samples stepped together')
+    args = parser.parse_args()
+
+    runner = build_runner(args.config, args.t_0)
+    os.makedirs(runner.args.image_folder, exist_ok=True)
+    server = EditServer(runner, max_batch=args.max_batch)
+    asyncio.run(serve_images(server, args.img_paths, args.edit_model_path, args.t_0,
+                             args.n_inv_step, args.n_test_step))
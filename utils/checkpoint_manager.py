@@ -0,0 +1,87 @@
+from collections import OrderedDict
+
+import torch
+
+from utils.tensor_file import load_state
+
+
+def state_nbytes(state):
+    return sum(v.numel() * v.element_size() for v in state.values())
+
+
+class CheckpointManager(object):
+    """Three-tier store of fine-tuned models.
+
+    The most recently used models stay on the device within `device_budget`
+    bytes, so switching between them is a dictionary lookup. Models evicted
+    from the device are kept as state dicts in pinned host memory within
+    `host_budget` bytes, and are dropped from there to the checkpoint files
+    on disk. A model evicted from the device is recycled for the incoming
+    checkpoint when the architectures match.
+    """
+
+    def __init__(self, device, device_budget, host_budget):
+        self.device = torch.device(device)
+        self.device_budget = device_budget
+        self.host_budget = host_budget
+        self.pin = torch.cuda.is_available() and self.device.type == 'cuda'
+
+        self.device_models = OrderedDict()
+        self.host_states = OrderedDict()
+        self.stats = {'device_hits': 0, 'host_hits': 0, 'misses': 0,
+                      'device_evictions': 0, 'host_evictions': 0}
+
+    def get(self, path, build_fn):
+        if path in self.device_models:
+            self.device_models.move_to_end(path)
+            self.stats['device_hits'] += 1
+            return self.device_models[path]
+
+        if path in self.host_states:
+            state = self.host_states.pop(path)
+            self.stats['host_hits'] += 1
+        else:
+            state = load_state(path)
+            self.stats['misses'] += 1
+
+        model = self._make_room(state)
+        if model is None:
+            model = build_fn().to(self.device)
+        model.load_state_dict(state)
+        model.eval()
+
+        self.device_models[path] = model
+        return model
+
+    def _make_room(self, state):
+        recycled = None
+        nbytes = state_nbytes(state)
+        while self.device_models and self._device_nbytes() + nbytes > self.device_budget:
+            path, model = self.device_models.popitem(last=False)
+            self.stats['device_evictions'] += 1
+            self._spill(path, model)
+            if recycled is None and self._compatible(model, state):
+                recycled = model
+        return recycled
+
+    def _spill(self, path, model):
+        state = OrderedDict()
+        for k, v in model.state_dict().items():
+            v = v.detach().to('cpu')
+            state[k] = v.pin_memory() if self.pin else v
+        self.host_states[path] = state
+
+        while self.host_states and self._host_nbytes() > self.host_budget:
+            self.host_states.popitem(last=False)
+            self.stats['host_evictions'] += 1
+
+    def _device_nbytes(self):
+        return sum(state_nbytes(m.state_dict()) for m in self.device_models.values())
+
+    def _host_nbytes(self):
+        return sum(state_nbytes(s) for s in self.host_states.values())
+
+    @staticmethod
+    def _compatible(model, state):
+        own = model.state_dict()
+        return own.keys() == state.keys() and all(own[k].shape == v.shape for k, v in state.items())
@@ -17,6 +17,32 @@ class _LogIt(torch.autograd.Function):
 def log_bwd(x, msg: str):
     return _LogIt.apply(x, msg)
 
+class DeepCache(object):
+    """Reuse of deep UNet decoder features across adjacent sampling steps.
+
+    Every `interval` steps the full model is evaluated and the input of its
+    last `branch` decoder blocks is stored. On the steps in between only the
+    first `branch` encoder blocks and the last `branch` decoder blocks are
+    evaluated, the deep part of the network is replaced by the stored features.
+    """
+
+    def __init__(self, interval, branch):
+        assert interval >= 1 and branch >= 1
+        self.interval = interval
+        self.branch = branch
+        self.features = None
+        self.reuse = False
+        self.n_step = 0
+
+    def step(self):
+        self.reuse = self.features is not None and self.n_step % self.interval != 0
+        self.n_step += 1
+
+
+def _eval(model, xt, t, cache):
+    return model(xt, t) if cache is None else model(xt, t, cache=cache)
+
+
 def get_beta_schedule(*, beta_start, beta_end, num_diffusion_timesteps):
     betas = np.linspace(beta_start, beta_end,
                         num_diffusion_timesteps, dtype=np.float64)
@@ -24,6 +50,21 @@ def get_beta_schedule(*, beta_start, beta_end, num_diffusion_timesteps):
     return betas
 
 
+def get_timestep_seq(n_step, t_0, skip_type='uniform'):
+    """Timesteps in [0, t_0] used by the sampler, in increasing order.
+    'quad' spaces them quadratically, i.e. denser near the clean image
+    where the ODE trajectory bends most."""
+    if skip_type == 'uniform':
+        seq = np.linspace(0, 1, n_step) * t_0
+    elif skip_type == 'quad':
+        seq = np.linspace(0, 1, n_step) ** 2 * t_0
+    else:
+        raise ValueError(f'Unknown skip type {skip_type}')
+    seq = [int(s) for s in list(seq)]
+    # quadratic spacing collapses the first steps for small t_0
+    return sorted(set(seq))
+
+
 def extract(a, t, x_shape):
     """Extract coefficients from a based on t and reshape to make it
     broadcastable with x_shape."""
@@ -35,6 +76,44 @@ def extract(a, t, x_shape):
     return out
 
 
+def _log_snr(a):
+    return 0.5 * (torch.log(a) - torch.log(1 - a))
+
+
+def multistep_update(xt, x0_t, at, at_next, x0_prevs, order):
+    """DPM-Solver++ multistep update in the data (x0) parameterization.
+
+    `x0_prevs` holds (alpha_cumprod, x0) of the previous steps, the most
+    recent one last. The solver is exact for a linear x0 trajectory in the
+    log-SNR, so it works in both directions: generation (log-SNR grows) and
+    inversion (log-SNR decreases). With no history it reduces to DDIM.
+    """
+    order = min(order, len(x0_prevs) + 1)
+    if order == 1 or (at_next == 1).all():
+        return at_next.sqrt() * x0_t + (1 - at_next).sqrt() * (xt - at.sqrt() * x0_t) / (1 - at).sqrt()
+
+    lambda_t, lambda_s0 = _log_snr(at_next), _log_snr(at)
+    h = lambda_t - lambda_s0
+    phi = torch.expm1(-h)
+    alpha_t, sigma_t, sigma_s0 = at_next.sqrt(), (1 - at_next).sqrt(), (1 - at).sqrt()
+
+    a1, m1 = x0_prevs[-1]
+    r0 = (lambda_s0 - _log_snr(a1)) / h
+    d1_0 = (x0_t - m1) / r0
+
+    if order == 2:
+        return sigma_t / sigma_s0 * xt - alpha_t * phi * x0_t - 0.5 * alpha_t * phi * d1_0
+
+    a2, m2 = x0_prevs[-2]
+    r1 = (_log_snr(a1) - _log_snr(a2)) / h
+    d1_1 = (m1 - m2) / r1
+    d1 = d1_0 + r0 / (r0 + r1) * (d1_0 - d1_1)
+    d2 = (d1_0 - d1_1) / (r0 + r1)
+    return sigma_t / sigma_s0 * xt - alpha_t * phi * x0_t \
+        + alpha_t * (phi / h + 1) * d1 \
+        - alpha_t * ((phi + h) / h ** 2 - 0.5) * d2
+
+
 def denoising_step(xt, t, t_next, *,
                    models,
                    logvars,
@@ -46,11 +125,13 @@ def denoising_step(xt, t, t_next, *,
                    hybrid_config=None,
                    ratio=1.0,
                    out_x0_t=False,
+                   cache=None,
+                   x0_prevs=None,
                    ):
     # Compute noise and variance
+    # with a list of models, `cache` is None or a list holding the DeepCache of every model
     if type(models) != list:
-        model = models
-        et = model(xt, t)
+        et = _eval(models, xt, t, cache)
         if learn_sigma:
             et, logvar_learned = torch.split(et, et.shape[1] // 2, dim=1)
             logvar = logvar_learned
@@ -60,8 +141,13 @@ def denoising_step(xt, t, t_next, *,
         if not hybrid:
             et = 0
             logvar = 0
-            if ratio != 0.0:
-                et_i = ratio * log_bwd(models[1](xt, t), msg=f'{t.item()}')
+            # a tensor holds one ratio per sample, then both models are evaluated
+            per_sample = torch.is_tensor(ratio)
+            if per_sample:
+                ratio = ratio.reshape((xt.shape[0],) + (1,) * (len(xt.shape) - 1))
+            caches = cache if cache is not None else [None] * len(models)
+            if per_sample or ratio != 0.0:
+                et_i = ratio * log_bwd(_eval(models[1], xt, t, caches[1]), msg=f'{t[0].item()}')
                 if learn_sigma:
                     et_i, logvar_learned = torch.split(et_i, et_i.shape[1] // 2, dim=1)
                     logvar += logvar_learned
@@ -69,8 +155,8 @@ def denoising_step(xt, t, t_next, *,
                     logvar += ratio * extract(logvars, t, xt.shape)
                 et += et_i
 
-            if ratio != 1.0:
-                et_i = (1 - ratio) * models[0](xt, t)
+            if per_sample or ratio != 1.0:
+                et_i = (1 - ratio) * _eval(models[0], xt, t, caches[0])
                 if learn_sigma:
                     et_i, logvar_learned = torch.split(et_i, et_i.shape[1] // 2, dim=1)
                     logvar += logvar_learned
@@ -79,6 +165,7 @@ def denoising_step(xt, t, t_next, *,
                 et += et_i
 
         else:
+            # the models change with t, their deep features are never reused
             for thr in list(hybrid_config.keys()):
                 if t.item() >= thr:
                     et = 0
@@ -101,6 +188,10 @@ def denoising_step(xt, t, t_next, *,
 
     if t_next.sum() == -t_next.shape[0]:
         at_next = torch.ones_like(at)
+    elif (t_next < 0).any():
+        # samples of a batch reach the clean image at different steps
+        at_next = extract((1.0 - b).cumprod(dim=0), t_next.clamp(min=0), xt.shape)
+        at_next = torch.where((t_next < 0).reshape(at_next.shape), torch.ones_like(at_next), at_next)
     else:
         at_next = extract((1.0 - b).cumprod(dim=0), t_next, xt.shape)
 
@@ -127,6 +218,12 @@ def denoising_step(xt, t, t_next, *,
             c2 = ((1 - at_next) - c1 ** 2).sqrt()
             xt_next = at_next.sqrt() * x0_t + c2 * et + c1 * torch.randn_like(xt)
 
+    elif sampling_type in ['dpm2m', 'dpm3m']:
+        x0_t = (xt - et * (1 - at).sqrt()) / at.sqrt()
+        order = 2 if sampling_type == 'dpm2m' else 3
+        prevs = [(extract((1.0 - b).cumprod(dim=0), t_i, xt.shape), x0_i) for t_i, x0_i in (x0_prevs or [])]
+        xt_next = multistep_update(xt, x0_t, at, at_next, prevs, order)
+
     if out_x0_t == True:
         return xt_next, x0_t
     else:
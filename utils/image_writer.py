@@ -0,0 +1,116 @@
+import os
+import queue
+import threading
+
+import numpy as np
+import torch
+import torchvision.utils as tvu
+from PIL import Image
+
+# format -> (extension, PIL format, quality option)
+FORMATS = {
+    'png': ('.png', 'PNG', 'compress_level'),
+    'jpg': ('.jpg', 'JPEG', 'quality'),
+    'webp': ('.webp', 'WEBP', 'quality'),
+    'npy': ('.npy', None, None),
+}
+
+
+class AsyncImageWriter(object):
+    """Writes images from background threads.
+
+    `write` only starts the copy of the images to pinned host memory and
+    queues them, the copy, the grid construction and the encoding happen on
+    the writer threads. At most `max_queue` writes are pending, `write`
+    blocks beyond that. `quality` is the PNG compression level (0-9) or the
+    JPEG / WebP quality (1-100), -1 keeps the defaults of PIL. The npy
+    format stores the raw float images in [-1, 1].
+
+    Every file is written to a temporary path and renamed, so an existing
+    file is always complete.
+    """
+
+    def __init__(self, fmt='png', quality=-1, per_image=False, max_queue=16, n_threads=2):
+        if fmt not in FORMATS:
+            raise ValueError(f'Unsupported image format {fmt}, choose from {list(FORMATS)}')
+        self.ext, self.pil_format, quality_key = FORMATS[fmt]
+        self.options = {quality_key: quality} if quality_key is not None and quality >= 0 else {}
+        self.per_image = per_image
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(n_threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def path(self, path):
+        """Path of the file written for `path`, with the extension of the format."""
+        return os.path.splitext(path)[0] + self.ext
+
+    def write(self, x, path, per_image=None):
+        """Queues the (N, 3, H, W) images `x` in [-1, 1]. They are saved as one
+        grid, or as <path>_<i> files if `per_image` (the writer default if None)."""
+        self._check()
+        per_image = self.per_image if per_image is None else per_image
+
+        x = x.detach()
+        event = None
+        if x.is_cuda:
+            host = torch.empty(x.shape, dtype=x.dtype, pin_memory=True)
+            host.copy_(x, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+            x = host
+
+        self.queue.put((x, event, self.path(path), per_image))
+
+    def flush(self):
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.flush()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            try:
+                self._save(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _save(self, x, event, path, per_image):
+        if event is not None:
+            event.synchronize()
+
+        if not per_image or len(x) == 1:
+            self._save_one(x if self.pil_format is None else tvu.make_grid(x, pad_value=-1), path)
+            return
+        stem, ext = os.path.splitext(path)
+        for i, x_i in enumerate(x):
+            self._save_one(x_i, f'{stem}_{i}{ext}')
+
+    def _save_one(self, x, path):
+        tmp_path = f'{path}.tmp'
+        if self.pil_format is None:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, x.float().numpy())
+        else:
+            # same conversion as torchvision.utils.save_image
+            ndarr = ((x + 1) * 0.5).mul(255).add_(0.5).clamp_(0, 255).permute(1, 2, 0).to(torch.uint8).numpy()
+            Image.fromarray(ndarr).save(tmp_path, format=self.pil_format, **self.options)
+        os.replace(tmp_path, path)
@@ -0,0 +1,70 @@
+"""
+Import-time benchmark of the entry points.
+
+Imports every module in a fresh interpreter, reports the import time and
+fails if a heavy dependency is pulled in at import time or if the import
+takes longer than --max_seconds. The heavy dependencies are only needed
+on some code paths and are imported there.
+
+Example:
+    python -m utils.import_benchmark --max_seconds 5
+"""
+
+import sys
+import json
+import argparse
+import subprocess
+
+ENTRY_POINTS = ['effdiff', 'main', 'serve']
+
+# module -> code path that is allowed to import it
+HEAVY_MODULES = {
+    'pynvml': 'nowhere',
+    'clip': 'fine-tuning (EffDiff._conf_loss)',
+    'dlib': '--align_face (EffDiff._open_image)',
+    'scipy': '--align_face (EffDiff._open_image)',
+    'lmdb': 'precompute from datasets (EffDiff.precompute_latents)',
+    'datasets.data_utils': 'precompute from datasets (EffDiff.precompute_latents)',
+    'datasets.shard_dataset': 'precompute from datasets (EffDiff.precompute_latents)',
+    'losses.clip_loss': 'fine-tuning (EffDiff._conf_loss)',
+    'losses.id_loss': 'fine-tuning with --id_loss_w',
+    'utils.align_utils': '--align_face (EffDiff._open_image)',
+}
+
+_PROBE = '''
+import sys, json, time
+time_start = time.time()
+import {module}
+print(json.dumps({{'seconds': time.time() - time_start, 'modules': sorted(sys.modules)}}))
+'''
+
+
+def measure(module):
+    out = subprocess.run([sys.executable, '-c', _PROBE.format(module=module)],
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def check(module, max_seconds=None):
+    result = measure(module)
+    loaded = [m for m in HEAVY_MODULES if m in result['modules']]
+
+    errors = [f'{module} imports {m}, only needed for {HEAVY_MODULES[m]}' for m in loaded]
+    if max_seconds is not None and result['seconds'] > max_seconds:
+        errors.append(f'{module} takes {result["seconds"]:.2f}s to import, more than {max_seconds:.2f}s')
+    print(f'{module}: {result["seconds"]:.4f}s, {len(result["modules"])} modules')
+    return errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the import time and dependencies of the entry points')
+    parser.add_argument('modules', type=str, nargs='*', default=ENTRY_POINTS, help='Modules to import')
+    parser.add_argument('--max_seconds', type=float, default=None, help='Max import time of every module')
+    args = parser.parse_args()
+
+    errors = []
+    for module in args.modules:
+        errors += check(module, args.max_seconds)
+    for error in errors:
+        print(error)
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,86 @@
+import os
+import hashlib
+from collections import OrderedDict
+
+import torch
+
+
+def tensor_digest(x):
+    return hashlib.sha1(x.detach().cpu().contiguous().numpy().tobytes()).hexdigest()
+
+
+def file_digest(path):
+    """Cheap digest of a checkpoint file: its path, size and modification time."""
+    st = os.stat(path)
+    return hashlib.sha1(f'{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}'.encode('utf-8')).hexdigest()
+
+
+def content_digest(path, chunk_size=1 << 20):
+    """Digest of the bytes of a file, unchanged by copies, touches and renames."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class LatentCache(object):
+    """LRU cache of inverted latents with an optional disk tier.
+
+    Latents are kept on the CPU, at most `max_items` of them in memory.
+    If `cache_dir` is given, every latent is also written there and
+    looked up on a memory miss, so the cache survives restarts.
+    """
+
+    def __init__(self, max_items=32, cache_dir=None):
+        self.max_items = max_items
+        self.cache_dir = cache_dir
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1('_'.join(str(p) for p in parts).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.pth')
+
+    def get(self, key):
+        if key in self.items:
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key]
+
+        if self.cache_dir is not None and os.path.exists(self._path(key)):
+            x_lat = torch.load(self._path(key), map_location='cpu')
+            self._insert(key, x_lat)
+            self.hits += 1
+            return x_lat
+
+        self.misses += 1
+        return None
+
+    def put(self, key, x_lat):
+        x_lat = x_lat.detach().cpu().clone()
+        self._insert(key, x_lat)
+
+        if self.cache_dir is not None:
+            # write-then-rename, concurrent readers never see a partial file
+            tmp_path = f'{self._path(key)}.{os.getpid()}.tmp'
+            torch.save(x_lat, tmp_path)
+            os.replace(tmp_path, self._path(key))
+
+    def _insert(self, key, x_lat):
+        if self.max_items <= 0:
+            return
+        self.items[key] = x_lat
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
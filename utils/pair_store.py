@@ -0,0 +1,81 @@
+import torch
+
+
+def pairs_nbytes(pairs):
+    return sum(t.numel() * t.element_size() for pair in pairs for t in pair)
+
+
+class PairStore(object):
+    """Image-latent pairs of precompute_latents staged for the training loop.
+
+    The pairs are moved to the device once if they fit in `device_budget`
+    bytes. Otherwise they are kept in pinned host memory, and iterating
+    copies the next pair on a side stream while the current one is in use,
+    so the training step never waits for a pageable synchronous copy.
+
+    With `stack`, the pairs are concatenated into three contiguous tensors
+    on the device regardless of the budget, and iterating slices batches of
+    `batch_size` out of them, in a random order drawn on the device if
+    `shuffle`.
+    """
+
+    def __init__(self, pairs, device, device_budget=0, stack=False, batch_size=1, shuffle=False):
+        self.device = torch.device(device)
+        self.stream = None
+        self.stacked = None
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+        if stack:
+            self.stacked = [torch.cat(ts, dim=0).to(self.device) for ts in zip(*pairs)]
+            self.pairs = None
+            print(f'{len(self.stacked[0])} images stacked on {self.device}')
+        elif self.device.type != 'cuda':
+            self.pairs = [[t.to(self.device) for t in pair] for pair in pairs]
+        elif pairs_nbytes(pairs) <= device_budget:
+            self.pairs = [[t.to(self.device) for t in pair] for pair in pairs]
+            print(f'{len(pairs)} pairs staged on {self.device}')
+        else:
+            self.pairs = [[t.pin_memory() for t in pair] for pair in pairs]
+            self.stream = torch.cuda.Stream(device=self.device)
+
+    def __len__(self):
+        if self.stacked is not None:
+            return (len(self.stacked[0]) + self.batch_size - 1) // self.batch_size
+        return len(self.pairs)
+
+    def __iter__(self):
+        if self.stacked is not None:
+            yield from self._batches()
+            return
+        if self.stream is None:
+            yield from self.pairs
+            return
+
+        current = torch.cuda.current_stream(self.device)
+        next_pair = self._prefetch(0) if self.pairs else None
+        for i in range(len(self.pairs)):
+            pair = next_pair
+            current.wait_stream(self.stream)
+            for t in pair:
+                # the memory of the copies belongs to the side stream
+                t.record_stream(current)
+            if i + 1 < len(self.pairs):
+                next_pair = self._prefetch(i + 1)
+            yield pair
+
+    def _batches(self):
+        n = len(self.stacked[0])
+        if not self.shuffle:
+            for i in range(0, n, self.batch_size):
+                yield [t[i:i + self.batch_size] for t in self.stacked]
+            return
+
+        order = torch.randperm(n, device=self.device)
+        for i in range(0, n, self.batch_size):
+            index = order[i:i + self.batch_size]
+            yield [t.index_select(0, index) for t in self.stacked]
+
+    def _prefetch(self, index):
+        with torch.cuda.stream(self.stream):
+            return [t.to(self.device, non_blocking=True) for t in self.pairs[index]]
@@ -2,13 +2,17 @@
     Refer to https://github.com/rosinality/stylegan2-pytorch/blob/master/prepare_data.py
 """
 
+import os
 import argparse
+import threading
 from io import BytesIO
+from queue import Queue, Full
 import multiprocessing
 from functools import partial
 
 from PIL import Image
 import lmdb
+import yaml
 from tqdm import tqdm
 from torchvision import datasets
 from torchvision.transforms import functional as trans_fn
@@ -35,43 +39,125 @@ def resize_multiple(
     return imgs
 
 
-def resize_worker(img_file, sizes, resample):
+def resize_worker(img_file, sizes, resample, quality=100):
     i, file = img_file
     img = Image.open(file)
     img = img.convert("RGB")
-    out = resize_multiple(img, sizes=sizes, resample=resample)
+    out = resize_multiple(img, sizes=sizes, resample=resample, quality=quality)
 
     return i, out
 
 
+def done_indices(env, size):
+    """Indices of the images already stored, at every size, by an interrupted run."""
+    prefix = f"{size}-".encode("utf-8")
+    with env.begin(write=False) as txn:
+        cursor = txn.cursor()
+        if not cursor.set_range(prefix):
+            return set()
+        done = set()
+        for key in cursor.iternext(values=False):
+            if not key.startswith(prefix):
+                break
+            done.add(int(key[len(prefix):]))
+    return done
+
+
+def writer(env, queue, commit_every, errors):
+    # large transactions, a commit (and fsync) per batch of images instead of per image
+    txn = env.begin(write=True)
+    n_pending = 0
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            for key, img in item:
+                txn.put(key, img)
+            n_pending += 1
+            if n_pending >= commit_every:
+                txn.commit()
+                txn = env.begin(write=True)
+                n_pending = 0
+        txn.commit()
+    except Exception as e:
+        txn.abort()
+        errors.append(e)
+
+
+def put(queue, item, writer_thread, errors, timeout=1.0):
+    # never block on a full queue once the writer is gone
+    while True:
+        if errors:
+            raise errors[0]
+        if not writer_thread.is_alive():
+            raise RuntimeError("The LMDB writer thread stopped")
+        try:
+            queue.put(item, timeout=timeout)
+            return
+        except Full:
+            pass
+
+
 def prepare(
-    env, dataset, n_worker, sizes=(128, 256, 512, 1024), resample=Image.LANCZOS
+    env, dataset, n_worker, sizes=(128, 256, 512, 1024), resample=Image.LANCZOS, quality=100, commit_every=1000
 ):
-    resize_fn = partial(resize_worker, sizes=sizes, resample=resample)
+    resize_fn = partial(resize_worker, sizes=sizes, resample=resample, quality=quality)
     files = sorted(dataset.imgs, key=lambda x: x[0])
     files = [(i, file) for i, (file, label) in enumerate(files)]
-    total = 0
-
-    with multiprocessing.Pool(n_worker) as pool:
-        for i, imgs in tqdm(pool.imap_unordered(resize_fn, files)):
-            for size, img in zip(sizes, imgs):
-                key = f"{size}-{str(i).zfill(5)}".encode("utf-8")
-
-                with env.begin(write=True) as txn:
-                    txn.put(key, img)
-
-            total += 1
-
-        with env.begin(write=True) as txn:
-            txn.put("length".encode("utf-8"), str(total).encode("utf-8"))
+    total = len(files)
+
+    # the sizes of an image are committed together, the last size marks it as done
+    done = done_indices(env, sizes[-1])
+    files = [(i, file) for i, file in files if i not in done]
+    if done:
+        print(f"Resuming: {len(done)} images already stored, {len(files)} left")
+
+    queue = Queue(maxsize=4 * commit_every)
+    writer_errors = []
+    writer_thread = threading.Thread(target=writer, args=(env, queue, commit_every, writer_errors))
+    writer_thread.start()
+    try:
+        # leaving the pool terminates the workers, also when the writer failed
+        with multiprocessing.Pool(n_worker) as pool:
+            for i, imgs in tqdm(pool.imap_unordered(resize_fn, files, chunksize=16), total=len(files)):
+                put(queue, [(f"{size}-{str(i).zfill(5)}".encode("utf-8"), img) for size, img in zip(sizes, imgs)],
+                    writer_thread, writer_errors)
+    finally:
+        while writer_thread.is_alive():
+            try:
+                queue.put(None, timeout=1.0)
+                break
+            except Full:
+                pass
+        writer_thread.join()
+
+    # the length marks a complete database, it is not written after a failure
+    if writer_errors:
+        raise writer_errors[0]
+    with env.begin(write=True) as txn:
+        txn.put("length".encode("utf-8"), str(total).encode("utf-8"))
+
+
+def config_sizes(config_dir="configs"):
+    """Image sizes used by the configs, the only ones the datasets read."""
+    sizes = set()
+    for name in os.listdir(config_dir):
+        if name.endswith(".yml"):
+            with open(os.path.join(config_dir, name), "r") as f:
+                sizes.add(yaml.safe_load(f)["data"]["image_size"])
+    return sorted(sizes)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--out", type=str)
-    parser.add_argument("--size", type=str, default="128,256,512,1024")
+    parser.add_argument("--size", type=str, default="128,256,512,1024",
+                        help="Comma separated sizes, or 'configs' for the sizes used by configs/*.yml")
     parser.add_argument("--n_worker", type=int, default=5)
     parser.add_argument("--resample", type=str, default="bilinear")
+    parser.add_argument("--quality", type=int, default=100, help="JPEG quality of the stored images")
+    parser.add_argument("--commit_every", type=int, default=1000, help="# of images per write transaction")
     parser.add_argument("path", type=str)
 
     args = parser.parse_args()
@@ -79,10 +165,14 @@ if __name__ == "__main__":
     resample_map = {"lanczos": Image.LANCZOS, "bilinear": Image.BILINEAR}
     resample = resample_map[args.resample]
 
-    sizes = [int(s.strip()) for s in args.size.split(",")]
+    if args.size == "configs":
+        sizes = config_sizes()
+    else:
+        sizes = [int(s.strip()) for s in args.size.split(",")]
     print(f"Make dataset of image sizes:", ", ".join(str(s) for s in sizes))
 
     imgset = datasets.ImageFolder(args.path)
 
     with lmdb.open(args.out, map_size=1024 ** 4, readahead=False) as env:
-        prepare(env, imgset, args.n_worker, sizes=sizes, resample=resample)
+        prepare(env, imgset, args.n_worker, sizes=sizes, resample=resample, quality=args.quality,
+                commit_every=args.commit_every)
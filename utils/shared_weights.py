@@ -0,0 +1,105 @@
+"""
+Base weights shared by the worker processes of a node.
+
+The first worker publishes the base checkpoint as a tensor file in shared
+memory, the other workers wait for it and map the same file, so the node
+holds a single copy of the base weights. The mapping is copy-on-write and
+inference never writes to it.
+
+Fine-tuned models are stored as deltas against the base. A delta file keeps
+only the tensors that differ from the base model; attaching it gives a model
+whose other parameters are still views of the shared base.
+
+Creation of a delta:
+    python -m utils.shared_weights pretrained/afhq_dog_4m.pt checkpoint/dog_bear_t500.pth
+"""
+
+import os
+import argparse
+from collections import OrderedDict
+
+import torch
+
+from utils.latent_cache import file_digest
+from utils.tensor_file import TENSOR_FILE_EXT, save_tensor_file, load_tensor_file, load_state, load_model
+
+SHM_DIR = '/dev/shm/effdiff'
+DELTA_EXT = '.delta' + TENSOR_FILE_EXT
+
+
+def is_delta_file(path):
+    return path is not None and path.endswith(DELTA_EXT)
+
+
+def publish(src_path, shm_dir=SHM_DIR):
+    """Path of the shared tensor file of `src_path`, written once per node."""
+    dst_path = os.path.join(shm_dir, file_digest(src_path) + TENSOR_FILE_EXT)
+    if os.path.exists(dst_path):
+        return dst_path
+
+    # POSIX only, imported on the single code path that locks
+    import fcntl
+
+    os.makedirs(shm_dir, exist_ok=True)
+    with open(dst_path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(dst_path):
+                print(f'Publishing {src_path} to {dst_path}')
+                save_tensor_file(load_state(src_path), dst_path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return dst_path
+
+
+def attach(build_fn, shared_path, delta_path=None):
+    """Model on the CPU bound to the shared base weights, with the tensors
+    of an optional delta file added on top as private copies."""
+    model = load_model(build_fn, shared_path, 'cpu')
+    if delta_path is not None:
+        apply_delta(model, load_tensor_file(delta_path))
+    model.eval()
+    return model
+
+
+def apply_delta(model, delta):
+    state = model.state_dict()
+    with torch.no_grad():
+        for name, d in delta.items():
+            # out of place, the shared pages of the base stay untouched
+            _set_tensor(model, name, state[name] + d)
+
+
+def _set_tensor(model, name, value):
+    *path, attr = name.split('.')
+    module = model
+    for p in path:
+        module = getattr(module, p)
+    if attr in module._parameters:
+        module._parameters[attr] = torch.nn.Parameter(value, requires_grad=module._parameters[attr].requires_grad)
+    else:
+        module._buffers[attr] = value
+
+
+def make_delta(base_state, ft_state, tol=0.0):
+    """Differences of the fine-tuned tensors that moved by more than `tol`."""
+    delta = OrderedDict()
+    for name, ft in ft_state.items():
+        d = ft.float() - base_state[name].float()
+        if d.abs().max() > tol:
+            delta[name] = d.to(ft.dtype)
+    return delta
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Store a fine-tuned checkpoint as a delta against the base model')
+    parser.add_argument('base', type=str, help='Base checkpoint')
+    parser.add_argument('ft', type=str, help='Fine-tuned checkpoint')
+    parser.add_argument('--tol', type=float, default=0.0, help='Tensors that moved less than tol are shared')
+    args = parser.parse_args()
+
+    base_state, ft_state = load_state(args.base), load_state(args.ft)
+    delta = make_delta(base_state, ft_state, args.tol)
+    dst_path = os.path.splitext(args.ft)[0] + DELTA_EXT
+    save_tensor_file(delta, dst_path)
+    print(f'{args.ft} -> {dst_path}: {len(delta)} of {len(ft_state)} tensors differ from the base')
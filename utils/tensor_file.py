@@ -0,0 +1,168 @@
+"""
+Memory-mapped tensor files for fast model startup.
+
+A tensor file is a JSON header followed by the raw bytes of every tensor:
+
+    [8 bytes: header length, little endian][header JSON][padding][data]
+
+The header maps every name to its dtype, shape and byte offset in the data
+section; offsets are aligned to 64 bytes. The optional __metadata__ entry
+holds strings, e.g. the digest of the checkpoint a file was converted from. Loading maps the file and wraps
+the mapped bytes into tensors without copying or unpickling anything.
+
+Conversion of an existing checkpoint:
+    python -m utils.tensor_file pretrained/afhq_dog_4m.pt pretrained/afhq_dog_4m.tensors
+"""
+
+import os
+import json
+import argparse
+import contextlib
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from utils.latent_cache import file_digest
+
+ALIGNMENT = 64
+TENSOR_FILE_EXT = '.tensors'
+METADATA_KEY = '__metadata__'
+
+_DTYPES = {
+    'float32': (torch.float32, np.float32),
+    'float16': (torch.float16, np.float16),
+    'float64': (torch.float64, np.float64),
+    'int64': (torch.int64, np.int64),
+    'int32': (torch.int32, np.int32),
+    'uint8': (torch.uint8, np.uint8),
+    'bool': (torch.bool, np.bool_),
+}
+_NAMES = {torch_dtype: name for name, (torch_dtype, _) in _DTYPES.items()}
+
+
+def is_tensor_file(path):
+    return path is not None and path.endswith(TENSOR_FILE_EXT)
+
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_tensor_file(state, path, metadata=None):
+    header = OrderedDict()
+    if metadata:
+        header[METADATA_KEY] = metadata
+    offset = 0
+    for name, tensor in state.items():
+        if tensor.dtype not in _NAMES:
+            raise ValueError(f'Unsupported dtype {tensor.dtype} of {name}')
+        header[name] = {'dtype': _NAMES[tensor.dtype], 'shape': list(tensor.shape), 'offset': offset}
+        offset = _align(offset + tensor.numel() * tensor.element_size())
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _align(8 + len(header_bytes))
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(len(header_bytes).to_bytes(8, 'little'))
+        f.write(header_bytes)
+        for name, tensor in state.items():
+            f.seek(data_start + header[name]['offset'])
+            f.write(tensor.detach().cpu().contiguous().numpy().tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def _read_header(path):
+    with open(path, 'rb') as f:
+        header_len = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(header_len).decode('utf-8'), object_pairs_hook=OrderedDict)
+    return header, _align(8 + header_len)
+
+
+def read_metadata(path):
+    return _read_header(path)[0].get(METADATA_KEY, {})
+
+
+def converted_path(src_path):
+    """Tensor file converted from `src_path` next to it, None if there is none
+    or if `src_path` was replaced since the conversion."""
+    path = os.path.splitext(src_path)[0] + TENSOR_FILE_EXT
+    if not os.path.exists(path):
+        return None
+    if read_metadata(path).get('source_digest') != file_digest(src_path):
+        print(f'{path} was not converted from the current {src_path}, it is not used')
+        return None
+    return path
+
+
+def load_tensor_file(path, mode='c'):
+    """State dict whose tensors are views of the memory-mapped file.
+    With mode 'c' the pages are shared until a tensor is written to,
+    mode 'r' gives read-only tensors."""
+    header, data_start = _read_header(path)
+    header.pop(METADATA_KEY, None)
+
+    data = np.memmap(path, dtype=np.uint8, mode=mode)
+    state = OrderedDict()
+    for name, meta in header.items():
+        torch_dtype, np_dtype = _DTYPES[meta['dtype']]
+        count = int(np.prod(meta['shape'], dtype=np.int64))
+        start = data_start + meta['offset']
+        array = data[start:start + count * np.dtype(np_dtype).itemsize].view(np_dtype)
+        state[name] = torch.from_numpy(array.reshape(meta['shape'])) if count else torch.empty(meta['shape'], dtype=torch_dtype)
+    return state
+
+
+@contextlib.contextmanager
+def _meta_device():
+    # parameters are not allocated nor initialized, they are bound later
+    if hasattr(torch, 'get_default_device'):
+        with torch.device('meta'):
+            yield True
+    else:
+        yield False
+
+
+def load_model(build_fn, path, device):
+    """Builds the model without allocating its weights and binds them
+    directly to the mapped tensors. On the CPU the model works on the
+    mapping itself, on other devices every weight is copied once."""
+    state = load_tensor_file(path)
+
+    with _meta_device() as on_meta:
+        model = build_fn()
+    if on_meta:
+        if str(device) != 'cpu':
+            state = OrderedDict((k, v.to(device)) for k, v in state.items())
+        model.load_state_dict(state, assign=True)
+    else:
+        model.load_state_dict(state)
+        model.to(device)
+    return model
+
+
+def load_state(path, map_location='cpu'):
+    """State dict of a tensor file or a pickled checkpoint."""
+    if is_tensor_file(path):
+        return load_tensor_file(path)
+    return torch.load(path, map_location=map_location)
+
+
+def convert(src_path, dst_path):
+    state = torch.load(src_path, map_location='cpu')
+    if 'state_dict' in state and isinstance(state['state_dict'], dict):
+        state = state['state_dict']
+    save_tensor_file(state, dst_path, metadata={'source_digest': file_digest(src_path)})
+    print(f'{src_path} -> {dst_path}: {len(state)} tensors')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert .pth/.pt/.ckpt checkpoints to tensor files')
+    parser.add_argument('src', type=str, help='Pickled checkpoint')
+    parser.add_argument('dst', type=str, nargs='?', default=None,
+                        help=f'Output tensor file, defaults to <src>{TENSOR_FILE_EXT}')
+    args = parser.parse_args()
+
+    convert(args.src, args.dst or os.path.splitext(args.src)[0] + TENSOR_FILE_EXT)